@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+
+# Authors:
+#   Bruno Menini Matosak
+#   Marcos Antônio de Almeida Rodrigues
+#   Tatiana Dias Tardelli Uehara
+
+# Benchmarks of the hot paths of the processing: the filters (single series
+# of several lengths and whole cubes), the outliers removal, the assembly of
+# area cubes, the CSV export, the rendering of animations and the retrieval
+# of points from the local stand-in of the WTSS server (modis_wtss_server.py,
+# started only when the fetch case runs). Each case runs on synthetic data
+# with a fixed seed, and reports the median time of one call, throughput and
+# peak memory. The results can be saved as a baseline and later runs
+# compared with it, failing when a case became slower than the tolerance.
+# The baseline of the repository is benchmark_baseline.json.
+#
+# Examples:
+#   python3 modis_benchmark.py --save benchmark_baseline.json
+#   python3 modis_benchmark.py --compare benchmark_baseline.json
+#   python3 modis_benchmark.py --quick --only filter
+
+import argparse
+import contextlib
+import datetime
+import gc
+import json
+import os
+import platform
+import sys
+import statistics
+import tempfile
+import timeit
+import tracemalloc
+import numpy as np
+import modis_processing as proc
+import modis_wtss
+import modis_wtss_server
+
+
+# Lengths of the single series and sizes (rows, columns, time) of the cubes
+series_lengths = [230, 460, 920]
+cube_sizes = [(100, 100, 230), (300, 300, 230)]
+
+# Smaller sizes, for a quick check
+quick_series_lengths = [230]
+quick_cube_sizes = [(50, 50, 230)]
+
+# Number of points retrieved from the stand-in server, and its latency per
+# request, in seconds
+fetch_points = 1000
+quick_fetch_points = 200
+fetch_latency = 0.02
+
+# Number of times the cases slower than the baseline are measured again
+# before they are reported as regressions, as the speed of shared machines
+# drops for a few seconds at a time
+confirm_runs = 2
+
+
+# Synthetic NDVI-like series: a seasonal cycle with noise and a few drops,
+# the same in every run
+def synthetic_series(shape, seed=0):
+    rng = np.random.RandomState(seed)
+    t = np.arange(shape[-1])
+    data = 0.5 + 0.3 * np.sin(2 * np.pi * t / 23.) + 0.05 * rng.standard_normal(shape)
+    drops = rng.random_sample(shape) < 0.03
+    data[drops] = data[drops] * 0.5
+    return data
+
+
+def synthetic_timeline(n):
+    return [datetime.date(2000, 2, 18) + datetime.timedelta(days=16 * k) for k in range(n)]
+
+
+# Reference workload, timed after every sample of the cases. The speed of
+# shared machines changes from one minute to the next by more than the
+# tolerance, so the cases are compared by their time relative to it, which
+# cancels most of that change. It mixes numpy and Python code (formatting
+# numbers as the exports do).
+reference_data = np.random.RandomState(1).random_sample(20000)
+reference_values = reference_data[:1000].tolist()
+
+
+def reference():
+    np.sort(reference_data)
+    ",".join([str(value * 2) for value in reference_values])
+
+
+# Takes repeat samples of the time of function(). As the fast cases take
+# less than a millisecond, each sample times a loop of as many calls as needed
+# to last at least 0.2 s (timeit.Timer.autorange), and is followed by a loop
+# of reference_calls calls of the reference workload. Returns the medians of
+# the time of one call, in seconds, and of its ratio to the time of one call
+# of the reference, the number of calls of each sample and the peak of the
+# memory allocated during one call, in bytes.
+def measure(function, repeat, reference_calls):
+    gc.collect()
+    timer = timeit.Timer(function)
+    reference_timer = timeit.Timer(reference)
+    [number, seconds] = timer.autorange()
+    samples = []
+    ratios = []
+    for n in range(repeat):
+        samples.append(timer.timeit(number) / number)
+        ratios.append(samples[-1] / (reference_timer.timeit(reference_calls) / reference_calls))
+
+    gc.collect()
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return statistics.median(samples), statistics.median(ratios), number, peak
+
+
+# Cases of the benchmark: (name, data, function, number of items, unit of
+# the items). data() creates the data of the case and function(data) is
+# what is measured, so only the data of the cases that run is created.
+def benchmark_cases(quick=False):
+    lengths = quick_series_lengths if quick else series_lengths
+    sizes = quick_cube_sizes if quick else cube_sizes
+    parameters = proc.default_parameters
+    cases = []
+
+    for n in lengths:
+        series = lambda n=n: synthetic_series((n,))
+        for name, label in proc.filters_list:
+            cases.append(("filter %s series %d" % (name, n), series,
+                          lambda data, name=name: proc.apply_filter(name, data, parameters), n, "values"))
+        cases.append(("remove_outliers series %d" % n, series,
+                      lambda data: proc.remove_outliers(data, parameters["percent_outliers_removal"]), n, "values"))
+
+    for size in sizes:
+        cube = lambda size=size: synthetic_series(size)
+        text = "%dx%dx%d" % size
+        n_values = size[0] * size[1] * size[2]
+        for name, label in proc.filters_list:
+            cases.append(("filter %s cube %s" % (name, text), cube,
+                          lambda data, name=name: proc.apply_filter(name, data, parameters, axis=2), n_values,
+                          "values"))
+        cases.append(("remove_outliers cube %s" % text, cube,
+                      lambda data: proc.remove_outliers(data, parameters["percent_outliers_removal"], axis=2),
+                      n_values, "values"))
+        cases.append(("assembly cube %s" % text, cube, lambda data: assemble(data, None), size[0] * size[1],
+                      "pixels"))
+        cases.append(("assembly on disk cube %s" % text, cube, lambda data: assemble(data, "cube.npy"),
+                      size[0] * size[1], "pixels"))
+
+    for n in lengths:
+        cases.append(("save_csv series %d" % n, lambda n=n: processed_series((n,)), export_csv, n, "rows"))
+
+    n_points = 100 if quick else 1000
+    cases.append(("save_points_csv %d points" % n_points, lambda: processed_series((n_points, 230)),
+                  export_points, n_points * 230, "rows"))
+
+    # Two years of frames, since encoding is much slower than the other cases
+    shape = sizes[0][:2] + (46,)
+    cases.append(("render gif cube %dx%dx%d" % shape, lambda: synthetic_series(shape),
+                  lambda data: render(data, "animation.gif"), shape[2], "frames"))
+
+    n_points = quick_fetch_points if quick else fetch_points
+    cases.append(("fetch %d points latency %g s" % (n_points, fetch_latency), lambda: n_points, fetch, n_points,
+                  "points"))
+
+    return cases
+
+
+# The cases that write files do it in a temporary directory
+work_dir = None
+
+
+def temporary_file(name):
+    return os.path.join(work_dir, name)
+
+
+# Writes the series of every pixel of a cube in its place of a new cube, as
+# the fetch engine does with the pixels that arrive
+def assemble(cube, file_name):
+    if file_name is not None:
+        file_name = temporary_file(file_name)
+    all_data = proc.new_cube(cube.shape, file_name)
+    [rows, cols] = np.nonzero(np.ones(cube.shape[:2], dtype=bool))
+    for i, j in zip(rows, cols):
+        all_data[i, j] = cube[i, j]
+    if file_name is not None:
+        all_data.flush()
+    return all_data
+
+
+# Synthetic series (one, or one per row) with the outliers removed and every
+# filter applied. The exports write series already processed, so only the
+# writing is measured.
+def processed_series(shape):
+    series = synthetic_series(shape)
+    filters = [name for name, label in proc.filters_list]
+    if series.ndim == 1:
+        return series, proc.process_series(series, filters, True)
+    return series, proc.process_points(series, filters, True)
+
+
+def export_csv(data):
+    [series, [data_wo_outlier, filtered]] = data
+    proc.save_csv(temporary_file("series.csv"), synthetic_timeline(len(series)), series, data_wo_outlier,
+                  filtered, True, "MOD13Q1", "ndvi", -22.5, -52.2)
+
+
+def export_points(data):
+    [points, [data_wo_outlier, filtered]] = data
+    ids = ["p%d" % n for n in range(len(points))]
+    coordinates = np.linspace(-22., -23., len(points))
+    proc.save_points_csv(temporary_file("points.csv"), synthetic_timeline(points.shape[1]), ids, coordinates,
+                         coordinates, points, data_wo_outlier, filtered, True, "MOD13Q1", "ndvi")
+
+
+def render(cube, file_name):
+    import modis_render
+    modis_render.render_animation(temporary_file(file_name), cube, synthetic_timeline(cube.shape[2]))
+
+
+# Retrieves the series of points of a line from the stand-in server, with
+# the local cache disabled, so every point is a request
+def fetch(n_points):
+    lats = np.linspace(-22.5, -22.5 - n_points * modis_wtss_server.spatial_resolution, n_points)
+    longs = np.full(n_points, -52.2)
+    with contextlib.redirect_stdout(open(os.devnull, "w")) as devnull:
+        with devnull:
+            proc.retrieveDataPoints(list(range(n_points)), lats, longs, "2005-01-01", "2015-01-01", "MOD13Q1",
+                                    "ndvi")
+
+
+# Cases whose names contain the text only (all of them when it is None)
+def select_cases(cases, only=None):
+    return [case for case in cases if only is None or only in case[0]]
+
+
+def run(cases, repeat):
+    results = {}
+    reference_calls = timeit.Timer(reference).autorange()[0]
+    for name, data, function, items, unit in cases:
+        data = data()
+        [seconds, relative, calls, peak] = measure(lambda: function(data), repeat, reference_calls)
+        data = None
+        results[name] = {"seconds": seconds, "relative": relative, "calls": calls, "samples": repeat,
+                         "throughput": items / seconds, "unit": unit + "/s", "peak_memory_mb": peak / 2. ** 20}
+        print("%-45s %12.4f ms %14.1f %-10s %9.1f MB" % (name, seconds * 1000, items / seconds, unit + "/s",
+                                                                peak / 2. ** 20))
+        sys.stdout.flush()
+    return results
+
+
+# Cases slower than the baseline by more than the tolerance (a fraction),
+# comparing the medians of the time of one call relative to the reference
+# workload (or of the time itself, with baselines saved without it)
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name in results:
+        if name in baseline["results"]:
+            key = "relative" if "relative" in baseline["results"][name] else "seconds"
+            ratio = results[name][key] / baseline["results"][name][key]
+            if ratio > 1 + tolerance:
+                regressions.append((name, ratio))
+    return regressions
+
+
+def main(argv=None):
+    global work_dir
+
+    parser = argparse.ArgumentParser(description="Benchmarks of the MODIS Time Series Filtering tool")
+    parser.add_argument("--quick", action="store_true", help="run only the smallest sizes")
+    parser.add_argument("--only", default=None, help="run only the cases whose names contain this text")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="number of samples of each case (the median is kept)")
+    parser.add_argument("--save", default=None, help="save the results as a baseline to this JSON file")
+    parser.add_argument("--compare", default=None, help="compare the results with the baseline of this JSON file")
+    parser.add_argument("--concurrency", type=int, default=proc.concurrency,
+                        help="number of requests in flight at the same time in the fetch case")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="fraction a case may be slower than the baseline before it is a regression")
+    args = parser.parse_args(argv)
+
+    cases = select_cases(benchmark_cases(args.quick), args.only)
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    # The stand-in server is started only when a fetch case runs
+    proc.set_cache_file(None)
+    proc.concurrency = args.concurrency
+    server = None
+    if any(name.startswith("fetch") for name, data, function, items, unit in cases):
+        [server, modis_wtss.wtss_server] = modis_wtss_server.spawn_server("--latency", str(fetch_latency))
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            results = run(cases, args.repeat)
+            regressions = []
+            if baseline is not None:
+                regressions = compare(results, baseline, args.tolerance)
+            for n in range(confirm_runs):
+                if len(regressions) == 0:
+                    break
+                print("Measuring again the cases slower than the baseline")
+                names = [name for name, ratio in regressions]
+                again = run([case for case in cases if case[0] in names], args.repeat)
+                for name in again:
+                    if again[name]["relative"] < results[name]["relative"]:
+                        results[name] = again[name]
+                regressions = compare(results, baseline, args.tolerance)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    report = {"date": datetime.datetime.now().isoformat(timespec="seconds"),
+              "machine": {"python": platform.python_version(), "numpy": np.__version__,
+                          "platform": platform.platform(), "processor": platform.processor()},
+              "results": results}
+
+    if args.save is not None:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+        print("Baseline saved in " + args.save)
+
+    if baseline is not None:
+        for name, ratio in regressions:
+            print("REGRESSION %s: %.2fx the baseline" % (name, ratio))
+        if len(regressions) > 0:
+            return 1
+        print("No regressions compared with " + args.compare)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+# Authors:
+#   Bruno Menini Matosak
+#   Marcos Antônio de Almeida Rodrigues
+#   Tatiana Dias Tardelli Uehara
+
+# Local cache of the time series downloaded from the WTSS server, stored in a
+# SQLite file. For every coverage, attribute and location the cache keeps the
+# values of each date and the interval of dates already asked to the server,
+# so a request inside that interval is answered locally and a request that
+# goes beyond it downloads only the missing dates. A file keeps the series of
+# a single WTSS server, recorded when it is created, and opening it for
+# another server (e.g. the local stand-in) is refused.
+
+import datetime
+import sqlite3
+import numpy as np
+
+
+# Dates closer to today than this number of days may still receive new
+# composites on the server, so they are never marked as complete
+settle_days = 32
+
+
+# Date of a date, a datetime or a text starting with YYYY-MM-DD (e.g. the
+# dates of the timelines of the server, which may come with the time)
+def to_date(d):
+    if isinstance(d, datetime.datetime):
+        return d.date()
+    if isinstance(d, datetime.date):
+        return d
+    return datetime.datetime.strptime(str(d)[:10], "%Y-%m-%d").date()
+
+
+class SeriesCache:
+
+    def __init__(self, file_name, server):
+        self.file_name = file_name
+        self.connection = sqlite3.connect(file_name, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS cache_info (name TEXT PRIMARY KEY, value TEXT)")
+        self.connection.execute("INSERT OR IGNORE INTO cache_info VALUES ('server', ?)", (server,))
+        self.server = self.connection.execute("SELECT value FROM cache_info WHERE name='server'").fetchone()[0]
+        if self.server != server:
+            self.connection.close()
+            raise ValueError("the cache %s has series of the server %s, not of %s" % (file_name, self.server,
+                                                                                       server))
+        self.connection.execute("CREATE TABLE IF NOT EXISTS series_values ("
+                                "coverage TEXT, attribute TEXT, lat REAL, long REAL, date TEXT, value REAL, "
+                                "PRIMARY KEY (coverage, attribute, lat, long, date))")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS series_ranges ("
+                                "coverage TEXT, attribute TEXT, lat REAL, long REAL, start TEXT, end TEXT, "
+                                "PRIMARY KEY (coverage, attribute, lat, long))")
+        self.connection.commit()
+
+    # Locations are stored with 6 decimals (about 0.1 m), so the same point
+    # typed twice or generated twice by an area job finds the same entry
+    def key(self, coverage, attribute, lat, long):
+        return coverage, attribute, round(float(lat), 6), round(float(long), 6)
+
+    # Returns the timeline and the values between date1 and date2. fetch(d1, d2)
+    # is called only for the dates missing in the cache, and must return the
+    # timeline and the values of the server for that interval.
+    def time_series(self, coverage, attribute, lat, long, date1, date2, fetch):
+        key = self.key(coverage, attribute, lat, long)
+        date1 = to_date(date1)
+        date2 = to_date(date2)
+
+        row = self.connection.execute("SELECT start, end FROM series_ranges "
+                                      "WHERE coverage=? AND attribute=? AND lat=? AND long=?", key).fetchone()
+
+        # intervals that have to be asked to the server
+        if row is None:
+            missing = [(date1, date2)]
+        else:
+            start = to_date(row[0])
+            end = to_date(row[1])
+            missing = []
+            if date1 < start:
+                missing.append((date1, start - datetime.timedelta(days=1)))
+            if date2 > end:
+                missing.append((end + datetime.timedelta(days=1), date2))
+
+        for d1, d2 in missing:
+            [timeline, values] = fetch(d1.isoformat(), d2.isoformat())
+            self.store(key, timeline, values, d1, d2)
+
+        rows = self.connection.execute("SELECT date, value FROM series_values "
+                                       "WHERE coverage=? AND attribute=? AND lat=? AND long=? "
+                                       "AND date BETWEEN ? AND ? ORDER BY date",
+                                       key + (date1.isoformat(), date2.isoformat())).fetchall()
+
+        timeline = [to_date(r[0]) for r in rows]
+        values = np.asarray([r[1] for r in rows], dtype=float)
+        return timeline, values
+
+    # Saves the values downloaded for [date1, date2] and extends the interval
+    # known for the location
+    def store(self, key, timeline, values, date1, date2):
+        self.connection.executemany("INSERT OR REPLACE INTO series_values VALUES (?, ?, ?, ?, ?, ?)",
+                                    [key + (to_date(t).isoformat(), float(v)) for t, v in zip(timeline, values)])
+
+        # the last days may still be updated on the server
+        date2 = min(date2, datetime.date.today() - datetime.timedelta(days=settle_days))
+
+        row = self.connection.execute("SELECT start, end FROM series_ranges "
+                                      "WHERE coverage=? AND attribute=? AND lat=? AND long=?", key).fetchone()
+        if row is not None:
+            date1 = min(date1, to_date(row[0]))
+            date2 = max(date2, to_date(row[1]))
+
+        if date2 >= date1:
+            self.connection.execute("INSERT OR REPLACE INTO series_ranges VALUES (?, ?, ?, ?, ?, ?)",
+                                    key + (date1.isoformat(), date2.isoformat()))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+
+# Authors:
+#   Bruno Menini Matosak
+#   Marcos Antônio de Almeida Rodrigues
+#   Tatiana Dias Tardelli Uehara
+
+# Command-line interface of the MODIS Time Series Filtering tool. It runs the
+# same processing as the graphical interface, without opening any window.
+#
+# Examples:
+#   python3 modis_cli.py point --lat -22.597063 --long -52.221069 --series ndvi \
+#       --filters SG,WT_E --outliers -o point.csv
+#   python3 modis_cli.py points --points points.csv --series ndvi --filters SG --outliers -o points.csv
+#   python3 modis_cli.py area --shapefile area.shp --series ndvi --filters mean -o area.npz
+#   python3 modis_cli.py render --input area.npz --layer mean -o area.mp4
+#   python3 modis_cli.py point --server http://localhost:8080 ... (a local modis_wtss_server.py)
+
+import argparse
+import datetime
+import os
+import sys
+import numpy as np
+import modis_metrics
+import modis_processing as proc
+import modis_render
+import modis_wtss
+
+
+# Reads the arguments common to the point and the area modes
+def add_common_arguments(parser):
+    parser.add_argument("--coverage", default="MOD13Q1", help="coverage (MOD13Q1 or MOD13Q1_M)")
+    parser.add_argument("--series", required=True, help="attribute of the coverage, e.g. ndvi")
+    parser.add_argument("--start", default="2005-01-01", help="start date (YYYY-MM-DD)")
+    parser.add_argument("--end", default="2015-01-01", help="end date (YYYY-MM-DD)")
+    parser.add_argument("--filters", default="",
+                        help="comma separated filters: " + ",".join(name for name, label in proc.filters_list))
+    parser.add_argument("--outliers", action="store_true", help="remove the outliers before filtering")
+    parser.add_argument("-o", "--output", required=True, help="output file")
+    parser.add_argument("--cache", default=None,
+                        help="SQLite file used as local cache of the downloaded time series")
+    parser.add_argument("--server", default=modis_wtss.wtss_server,
+                        help="address of the WTSS server (e.g. a local modis_wtss_server.py)")
+    parser.add_argument("--max_attempts", type=int, default=modis_wtss.max_attempts,
+                        help="maximum number of attempts of each request to the server")
+    parser.add_argument("--timeout", type=float, default=modis_wtss.request_timeout,
+                        help="timeout of each request to the server, in seconds")
+    parser.add_argument("--concurrency", type=int, default=proc.concurrency,
+                        help="number of requests to the server in flight at the same time")
+    parser.add_argument("--metrics", default=None,
+                        help="JSON file where the time, items and bytes of each stage of the job and the "
+                             "latencies of the requests to the server are written")
+
+    # Every parameter of the filters can be changed, e.g. --window_size_SG 7
+    for name, value in proc.default_parameters.items():
+        if name == "percent_outliers_removal":
+            parser.add_argument("--" + name, type=float, default=value)
+        else:
+            parser.add_argument("--" + name, type=int, default=value)
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(description="MODIS (MOD13Q1) Time Series Filtering")
+    subparsers = parser.add_subparsers(dest="mode")
+    subparsers.required = True
+
+    point = subparsers.add_parser("point", help="process the time series of one point and save it to CSV "
+                                                 "(or to Parquet/Feather, by the extension of the output)")
+    point.add_argument("--lat", type=float, required=True, help="latitude (decimal degrees)")
+    point.add_argument("--long", type=float, required=True, help="longitude (decimal degrees)")
+    add_common_arguments(point)
+
+    points = subparsers.add_parser("points", help="process the time series of the points of a CSV (columns lat, "
+                                                   "long and optionally id) or GeoJSON file and save them to a "
+                                                   "single CSV, Parquet or Feather file")
+    points.add_argument("--points", required=True, help="CSV or GeoJSON file with the points (EPSG 4326)")
+    add_common_arguments(points)
+
+    area = subparsers.add_parser("area", help="process the area of a shapefile and save it to a .npz, "
+                                               "NetCDF (.nc) or GeoTIFF (.tif) file")
+    area.add_argument("--shapefile", required=True, help="shapefile with the polygons (EPSG 4326)")
+    area.add_argument("--cube", default=None,
+                      help=".npy file where the area is kept on disk instead of in memory "
+                           "(the filtered areas are kept in files next to it)")
+    area.add_argument("--animation", default=None,
+                      help="also render the animation of the area to this MP4 or GIF file (or PNG directory)")
+    area.add_argument("--jobs", default=None,
+                      help="directory where the job is saved tile by tile, so it can be resumed if interrupted")
+    add_common_arguments(area)
+
+    render = subparsers.add_parser("render", help="render the animation of an area saved by the area mode "
+                                                   "(.npz, or .npy cube) to MP4, GIF or PNG images")
+    render.add_argument("--input", required=True, help=".npz file of an area, or .npy cube")
+    render.add_argument("--layer", default="raw", help="raw or the name of a filter saved in the file")
+    render.add_argument("-o", "--output", required=True,
+                        help="MP4 or GIF file, or directory for a sequence of PNG images")
+    render.add_argument("--fps", type=int, default=10, help="frames per second")
+    render.add_argument("--size", type=int, default=modis_render.max_size,
+                        help="largest number of pixels of each side of the frames")
+    render.add_argument("--metrics", default=None, help="JSON file where the time of the rendering is written")
+
+    args = parser.parse_args(argv)
+
+    if args.mode == "render":
+        return args
+
+    # Check if dates inserted correctly
+    try:
+        date1 = datetime.datetime.strptime(args.start, "%Y-%m-%d")
+        date2 = datetime.datetime.strptime(args.end, "%Y-%m-%d")
+    except ValueError:
+        parser.error("dates must be in the format YYYY-MM-DD")
+    if (date2 - date1).days < 0:
+        parser.error("end date < start date")
+
+    args.filters = [f for f in args.filters.split(",") if f != ""]
+    for f in args.filters:
+        if f not in [name for name, label in proc.filters_list]:
+            parser.error("unknown filter: " + f)
+
+    return args
+
+
+# Renders the animation of an area saved to a file
+def render(args):
+    if args.input.lower().endswith(".npy"):
+        cube = proc.open_cube(proc.companion_file(args.input, args.layer) if args.layer != "raw" else args.input)
+        tline = None
+    else:
+        saved = np.load(args.input)
+        cube = saved[args.layer]
+        tline = saved["timeline"]
+    output = modis_render.render_animation(args.output, cube, tline, fps=args.fps, size=args.size)
+    print("Animation saved in " + output)
+    return 0
+
+
+# Stops with an error message, as argparse does with the arguments
+def fail(message):
+    print("modis_cli.py: error: " + message, file=sys.stderr)
+    sys.exit(2)
+
+
+# Stops when the series are too short for the windows of the selected filters
+def check_length(tline, filters, parameters):
+    try:
+        proc.check_length(len(tline), filters, parameters)
+    except ValueError as err:
+        fail(str(err))
+
+
+# Size, in bytes, of the output of a job and of the files of each filter
+# written next to it
+def output_size(args, filtered):
+    names = [args.output] + [proc.companion_file(args.output, name) for name in filtered]
+    return sum(modis_metrics.file_size(name) for name in names)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    if args.metrics is None:
+        return run(args)
+
+    modis_metrics.start_job(args.mode, vars(args))
+    try:
+        status = run(args)
+    except BaseException as err:
+        modis_metrics.finish_job(args.metrics, repr(err))
+        raise
+    modis_metrics.finish_job(args.metrics)
+    print("Metrics saved in " + args.metrics)
+    return status
+
+
+def run(args):
+    if args.mode == "render":
+        return render(args)
+    parameters = {name: getattr(args, name) for name in proc.default_parameters}
+    proc.set_cache_file(args.cache)
+    modis_wtss.wtss_server = args.server
+    try:
+        proc.get_cache()
+    except ValueError as err:
+        fail(str(err))
+    modis_wtss.max_attempts = args.max_attempts
+    modis_wtss.request_timeout = args.timeout
+    proc.concurrency = args.concurrency
+    if args.mode == "area":
+        proc.set_jobs_dir(args.jobs)
+
+    # the list of failures of an earlier run with the same output is removed,
+    # so it never contradicts the output of this one
+    failures_file = args.output + ".failures.csv"
+    if args.mode in ("points", "area") and os.path.exists(failures_file):
+        os.remove(failures_file)
+
+    if args.mode == "point":
+        with modis_metrics.stage("fetch") as counts:
+            [tline, data_raw] = proc.retrieveDataFromPoint(args.lat, args.long, args.coverage, args.series,
+                                                           args.start, args.end)
+            counts["items"] = 1
+            counts["bytes"] = data_raw.nbytes
+        check_length(tline, args.filters, parameters)
+        with modis_metrics.stage("filtering") as counts:
+            [data_wo_outlier, filtered] = proc.process_series(data_raw, args.filters, args.outliers, parameters)
+            counts["items"] = len(data_raw)
+            counts["bytes"] = data_raw.nbytes
+        with modis_metrics.stage("export") as counts:
+            if args.output.lower().endswith((".parquet", ".feather")):
+                proc.save_columnar(args.output, tline, data_raw, data_wo_outlier, filtered, args.outliers,
+                                   args.coverage, args.series, args.lat, args.long, parameters)
+            else:
+                proc.save_csv(args.output, tline, data_raw, data_wo_outlier, filtered, args.outliers,
+                              args.coverage, args.series, args.lat, args.long, parameters)
+            counts["items"] = len(data_raw)
+            counts["bytes"] = output_size(args, {})
+
+    elif args.mode == "points":
+        [ids, lats, longs] = proc.read_points(args.points)
+        [tline, all_data, failures] = proc.retrieveDataPoints(ids, lats, longs, args.start, args.end,
+                                                              args.coverage, args.series)
+        check_length(tline, args.filters, parameters)
+        [data_wo_outlier, filtered] = proc.process_points(all_data, args.filters, args.outliers, parameters)
+        with modis_metrics.stage("export") as counts:
+            if args.output.lower().endswith((".parquet", ".feather")):
+                proc.save_points_columnar(args.output, tline, ids, lats, longs, all_data, data_wo_outlier,
+                                          filtered, args.outliers, args.coverage, args.series, parameters)
+            else:
+                proc.save_points_csv(args.output, tline, ids, lats, longs, all_data, data_wo_outlier, filtered,
+                                     args.outliers, args.coverage, args.series, parameters)
+            counts["items"] = all_data.size
+            counts["bytes"] = output_size(args, {})
+
+        if len(failures) > 0:
+            proc.save_failures(failures_file, failures)
+            print("Points not retrieved listed in " + failures_file)
+
+    elif args.mode == "area":
+        [polys, records] = proc.read_features(args.shapefile)
+        [long1, lat1, long2, lat2] = proc.features_bounds(polys)
+        [tline, all_data, failures, labels] = proc.retrieveDataMatrix(lat1, lat2, long1, long2, args.start,
+                                                                      args.end, args.coverage, args.series, polys,
+                                                                      args.outliers,
+                                                                      parameters["percent_outliers_removal"],
+                                                                      args.cube)
+        check_length(tline, args.filters, parameters)
+        filtered = proc.process_matrix(all_data, args.filters, parameters, args.cube)
+        with modis_metrics.stage("export") as counts:
+            if args.output.lower().endswith(".nc"):
+                [lats, longs] = proc.area_grid(lat1, lat2, long1, long2, args.coverage)
+                proc.save_netcdf(args.output, tline, lats, longs, all_data, filtered, args.outliers, args.coverage,
+                                 args.series, parameters, labels, records)
+            elif args.output.lower().endswith((".tif", ".tiff")):
+                [lats, longs] = proc.area_grid(lat1, lat2, long1, long2, args.coverage)
+                proc.save_geotiff(args.output, tline, lats, longs, all_data, filtered, args.outliers, args.coverage,
+                                  args.series, parameters)
+            else:
+                proc.save_matrix(args.output, tline, all_data, filtered, labels, records)
+            counts["items"] = all_data.size * (1 + len(filtered))
+            counts["bytes"] = output_size(args, filtered)
+
+        if args.animation is not None:
+            output = modis_render.render_animation(args.animation, all_data, tline, args.series.upper())
+            print("Animation saved in " + output)
+
+        if len(failures) > 0:
+            proc.save_failures(failures_file, failures)
+            print("Pixels not retrieved listed in " + failures_file)
+
+    print("Data saved in " + args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
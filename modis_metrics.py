@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+# Authors:
+#   Bruno Menini Matosak
+#   Marcos Antônio de Almeida Rodrigues
+#   Tatiana Dias Tardelli Uehara
+
+# Metrics of the jobs: the time, the number of items and the number of bytes
+# of each stage (reading the polygons, describing the coverage, fetching,
+# assembling the cube, removing the outliers, filtering, rendering, ...) and
+# histograms of the latency of the requests to the WTSS server. While a job
+# is started (start_job), the processing adds its stages to it; otherwise
+# the measures are discarded. The report of a job is written as JSON.
+#
+# Stages may be nested: the assembly of the cube happens during the fetch,
+# so its time is also part of the time of the fetch.
+
+import bisect
+import datetime
+import json
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from time import perf_counter, time
+
+
+# Upper bounds of the buckets of the latency histograms, in seconds (the last
+# bucket has the slower requests)
+latency_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60.]
+
+
+class JobMetrics:
+
+    def __init__(self, name, info=None):
+        self.name = name
+        self.info = info or {}
+        self.started = time()
+        self.clock = perf_counter()
+        self.stages = OrderedDict()
+        self.requests = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add_stage(self, name, seconds, items=0, bytes=0):
+        with self.lock:
+            entry = self.stages.setdefault(name, {"seconds": 0., "items": 0, "bytes": 0, "calls": 0})
+            entry["seconds"] += seconds
+            entry["items"] += int(items)
+            entry["bytes"] += int(bytes)
+            entry["calls"] += 1
+
+    def add_request(self, operation, seconds, ok):
+        with self.lock:
+            histogram = self.requests.get(operation)
+            if histogram is None:
+                histogram = {"count": 0, "failed": 0, "seconds": 0., "min": seconds, "max": seconds,
+                             "counts": [0] * (len(latency_buckets) + 1)}
+                self.requests[operation] = histogram
+            histogram["count"] += 1
+            histogram["failed"] += 0 if ok else 1
+            histogram["seconds"] += seconds
+            histogram["min"] = min(histogram["min"], seconds)
+            histogram["max"] = max(histogram["max"], seconds)
+            histogram["counts"][bisect.bisect_left(latency_buckets, seconds)] += 1
+
+    def report(self, error=None):
+        with self.lock:
+            stages = OrderedDict()
+            for name, entry in self.stages.items():
+                stages[name] = dict(entry, items_per_second=rate(entry["items"], entry["seconds"]),
+                                    mb_per_second=rate(entry["bytes"] / 2. ** 20, entry["seconds"]))
+
+            requests = OrderedDict()
+            for operation, histogram in self.requests.items():
+                requests[operation] = {"count": histogram["count"], "failed": histogram["failed"],
+                                       "mean": histogram["seconds"] / histogram["count"],
+                                       "min": histogram["min"], "max": histogram["max"],
+                                       "p50": quantile(histogram, 0.5), "p90": quantile(histogram, 0.9),
+                                       "p99": quantile(histogram, 0.99),
+                                       "histogram": [{"le": bound, "count": count} for bound, count
+                                                     in zip(latency_buckets + [None], histogram["counts"])]}
+
+        return {"job": self.name,
+                "info": self.info,
+                "started": datetime.datetime.fromtimestamp(self.started).isoformat(timespec="seconds"),
+                "seconds": perf_counter() - self.clock,
+                "status": "failed" if error is not None else "completed",
+                "error": error,
+                "stages": stages,
+                "requests": requests}
+
+    def save(self, file_name, error=None):
+        with open(file_name, "w") as f:
+            json.dump(self.report(error), f, indent=2, default=str)
+
+
+def rate(amount, seconds):
+    return amount / seconds if seconds > 0 else None
+
+
+# Upper bound of the bucket where the quantile q of the latencies falls (the
+# largest latency when it is in the last bucket)
+def quantile(histogram, q):
+    total = 0
+    for bound, count in zip(latency_buckets, histogram["counts"]):
+        total += count
+        if total >= q * histogram["count"]:
+            return min(bound, histogram["max"])
+    return histogram["max"]
+
+
+# Job being measured, or None
+current_job = None
+
+
+def start_job(name, info=None):
+    global current_job
+    current_job = JobMetrics(name, info)
+    return current_job
+
+
+# Ends the current job, writing its report to file_name, when given. error
+# is the description of the error that stopped the job, if any.
+def finish_job(file_name=None, error=None):
+    global current_job
+    job = current_job
+    current_job = None
+    if job is None:
+        return None
+    if file_name is not None:
+        job.save(file_name, error)
+    return job.report(error)
+
+
+def add_stage(name, seconds, items=0, bytes=0):
+    job = current_job
+    if job is not None:
+        job.add_stage(name, seconds, items, bytes)
+
+
+def add_request(operation, seconds, ok):
+    job = current_job
+    if job is not None:
+        job.add_request(operation, seconds, ok)
+
+
+# Measures the time of a block as a stage of the current job. The block sets
+# the number of items and bytes it processed in the dict it receives:
+#
+#   with modis_metrics.stage("filtering") as counts:
+#       ...
+#       counts["items"] = all_data.size
+@contextmanager
+def stage(name):
+    counts = {"items": 0, "bytes": 0}
+    t = perf_counter()
+    try:
+        yield counts
+    finally:
+        add_stage(name, perf_counter() - t, counts["items"], counts["bytes"])
+
+
+# Size of a file, or of all the files of a directory, in bytes
+def file_size(file_name):
+    if os.path.isdir(file_name):
+        return sum(os.path.getsize(os.path.join(file_name, name)) for name in os.listdir(file_name))
+    if os.path.exists(file_name):
+        return os.path.getsize(file_name)
+    return 0
@@ -0,0 +1,1295 @@
+# -*- coding: utf-8 -*-
+
+# Authors:
+#   Bruno Menini Matosak
+#   Marcos Antônio de Almeida Rodrigues
+#   Tatiana Dias Tardelli Uehara
+
+# Processing engine of the MODIS Time Series Filtering tool.
+# Nothing in this module depends on Gtk or matplotlib, so it can be used both
+# by the graphical interface and by the command-line interface (modis_cli.py)
+# on machines without a display.
+
+import asyncio
+import csv
+import datetime
+import hashlib
+import json
+import math
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from itertools import islice
+from os.path import join as path_join
+from time import perf_counter, time
+import scipy.sparse as sparse
+from scipy.sparse.linalg import splu
+from shapely.geometry import Point, shape
+from shapely.prepared import prep
+import numpy as np
+import shapefile as shp
+from modis_cache import SeriesCache
+import modis_metrics
+import modis_wtss
+
+# Spatial index with vectorized queries, available from shapely 2.0
+try:
+    from shapely import STRtree, points
+except ImportError:
+    STRtree = None
+
+# Parquet and Feather files are written with pyarrow, when it is installed
+try:
+    import pyarrow
+    import pyarrow.feather as feather
+    import pyarrow.parquet as parquet
+except ImportError:
+    pyarrow = None
+
+# NetCDF files are written with netCDF4 and GeoTIFF files with rasterio,
+# when they are installed
+try:
+    import netCDF4
+except ImportError:
+    netCDF4 = None
+
+try:
+    import rasterio
+    from rasterio.transform import from_origin
+    from rasterio.windows import Window as RasterWindow
+except ImportError:
+    rasterio = None
+
+
+# SQLite file of the local cache of time series (None disables the cache)
+cache_file = None
+
+# Directory where area jobs save their finished tiles (None disables the
+# checkpoints)
+jobs_dir = None
+
+# Side, in pixels, of the tiles of an area job saved with checkpoints
+tile_size = 64
+
+# Number of requests to the server in flight at the same time in area jobs
+concurrency = 64
+
+# Number of rows of an area cube processed at once by the outliers removal
+# and the filters, which bounds the memory used when the cube is on disk
+rows_per_block = 64
+
+# Number of rows written at once to the CSV files, which bounds the memory
+# used to save a batch of points
+csv_rows_per_block = 10000
+
+# Default parameters for the filters and the outliers removal
+default_parameters = {
+    # Pyramid filter
+    "window_size_pyramid": 3,
+
+    # Mean Filter
+    "window_size_mean": 3,
+
+    # Savitzky-Golay filter
+    "window_size_SG": 5,
+    "order_SG": 3,
+    "deriv_SG": 0,
+    "rate_SG": 1,
+
+    # Wittaker-Eilers filter
+    "window_size_WT_E": 5,
+    "lmbd_WT_E": 10,
+
+    # Gauss filter
+    "window_size_GA": 5,
+    "sigma_GA": 1,
+
+    # Outliers removal
+    "percent_outliers_removal": 1,
+}
+
+# Available filters, in the order they are applied, plotted and saved,
+# with the label used for them in graphs and files
+filters_list = [("pyramid", "Pyramid Filter"),
+                ("mean", "Mean Filter"),
+                ("gauss", "Gauss Filter"),
+                ("SG", "Savitzky-Golay Filter"),
+                ("WT_E", "Wittaker-Eilers Filter")]
+
+# Parameters used by each filter
+filter_parameters = {"pyramid": ["window_size_pyramid"],
+                     "mean": ["window_size_mean"],
+                     "gauss": ["window_size_GA", "sigma_GA"],
+                     "SG": ["window_size_SG", "order_SG", "deriv_SG", "rate_SG"],
+                     "WT_E": ["window_size_WT_E", "lmbd_WT_E"]}
+
+# Number of series whose processing results are kept in memory
+pipelines_cached = 16
+
+
+#########################################################################
+# - Data retrieval
+#########################################################################
+def set_cache_file(file_name):
+    global cache_file
+    cache_file = file_name
+
+
+def set_jobs_dir(dir_name):
+    global jobs_dir
+    jobs_dir = dir_name
+
+
+# Caches opened by each thread. SQLite connections can't be shared between
+# threads, so each thread of the fetch engine opens its own. A cache holds
+# the series of the server set when it was opened.
+opened_caches = threading.local()
+
+
+def get_cache():
+    if cache_file is None:
+        return None
+    key = (cache_file, modis_wtss.wtss_server)
+    if getattr(opened_caches, "key", None) != key:
+        opened_caches.key = None
+        opened_caches.cache = SeriesCache(cache_file, modis_wtss.wtss_server)
+        opened_caches.key = key
+    return opened_caches.cache
+
+
+# Gets the time series of one point, from the local cache when it is enabled
+# and from the server otherwise. Setting the event cancel stops the retries
+# with JobCancelled.
+def retrieveDataFromPoint(lat, long, coverage, series, date1, date2, cancel=None):
+    cache = get_cache()
+    if cache is None:
+        return modis_wtss.downloadDataFromPoint(lat, long, coverage, series, date1, date2, cancel)
+    return cache.time_series(coverage, series, lat, long, date1, date2,
+                             partial(modis_wtss.downloadDataFromPoint, lat, long, coverage, series, cancel=cancel))
+
+
+# Gets the time series of one pixel of an area job. job_state holds what is
+# common to all the pixels (coverage, series and dates). Returns the data and
+# None, or None and the error when the pixel could not be retrieved after all
+# the attempts.
+def retrieveDataFromPoint2(job_state, lat, long, cancel=None):
+    try:
+        [timeline, data] = retrieveDataFromPoint(lat, long, job_state["coverage"], job_state["series"],
+                                                 job_state["date1"], job_state["date2"], cancel)
+        return data, None
+    except Exception as err:
+        return None, repr(err)
+
+
+# Feature of each point of the grid lats x longs: the index, in the list
+# polys, of the polygon that contains it, or -1 outside all of them (the
+# first polygon wins where they overlap). With shapely 2 the points are
+# queried at once in an STRtree of the polygons, so each point is tested only
+# against the polygons whose bounding boxes contain it. Older versions test,
+# for each polygon, the points inside its bounding box.
+def feature_labels(polys, lats, longs):
+    if not isinstance(polys, (list, tuple)):
+        polys = [polys]
+
+    [xx, yy] = np.meshgrid(longs, lats)
+    labels = np.full(xx.shape, len(polys))
+
+    if STRtree is not None:
+        tree = STRtree(polys)
+        [point_index, poly_index] = tree.query(points(xx.ravel(), yy.ravel()), predicate="within")
+        np.minimum.at(labels.reshape(-1), point_index, poly_index)
+    else:
+        for n in reversed(range(len(polys))):
+            [minx, miny, maxx, maxy] = polys[n].bounds
+            prepared = prep(polys[n])
+            candidates = (xx >= minx) & (xx <= maxx) & (yy >= miny) & (yy <= maxy)
+            for i, j in zip(*np.nonzero(candidates)):
+                if prepared.contains(Point(xx[i, j], yy[i, j])):
+                    labels[i, j] = n
+
+    labels[labels == len(polys)] = -1
+    return labels
+
+
+# Raised by an area job stopped through its cancel event (defined with the
+# retries, which also stop when the job is cancelled)
+JobCancelled = modis_wtss.JobCancelled
+
+
+# Fetch engine of the area jobs. asyncio keeps up to n_requests requests in
+# flight; as the wtss client is blocking, each request runs in a thread of
+# an executor of the same size. Every thread reuses its own client
+# connection, and the job state is shared by all of them without copies.
+# The results are not kept: receive(n, data, error) is called for the n-th
+# pixel as soon as it arrives, in any order, and a new request is started.
+# When the event cancel is set, the requests not started are dropped and
+# the job returns at once; the ones still running make no further attempts.
+async def fetch_pixels_async(job_state, coord, receive, n_requests, cancel=None):
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=n_requests)
+    in_flight = {}
+    waiting = iter(range(len(coord)))
+
+    def start(n):
+        task = loop.run_in_executor(executor, retrieveDataFromPoint2, job_state, coord[n][0], coord[n][1], cancel)
+        in_flight[task] = n
+
+    try:
+        for n in islice(waiting, n_requests):
+            start(n)
+
+        while len(in_flight) > 0:
+            [done, pending] = await asyncio.wait(in_flight, timeout=0.2, return_when=asyncio.FIRST_COMPLETED)
+            if cancel is not None and cancel.is_set():
+                raise JobCancelled()
+            for task in done:
+                [data, error] = task.result()
+                receive(in_flight.pop(task), data, error)
+                for n in islice(waiting, 1):
+                    start(n)
+    finally:
+        for task in in_flight:
+            task.cancel()
+        executor.shutdown(wait=len(in_flight) == 0, cancel_futures=True)
+
+
+# Fetches the pixels of the list coord ([lat, long] pairs), passing each one
+# to receive(n, data, error) as it arrives
+def fetch_pixels(job_state, coord, receive, n_requests=None, cancel=None):
+    if n_requests is None:
+        n_requests = concurrency
+    asyncio.run(fetch_pixels_async(job_state, coord, receive, n_requests, cancel))
+
+
+# Latitudes of the rows and longitudes of the columns of the grid of pixels
+# of an area, based on the spatial resolution of the coverage
+def area_grid(lat1, lat2, long1, long2, coverage):
+    cv_scheme = modis_wtss.describe_coverage(coverage)
+
+    # range i (height) and j (width)
+    r_i = int((lat2 - lat1) / cv_scheme["spatial_resolution"]["y"]) + 1
+    r_j = int((long2 - long1) / cv_scheme["spatial_resolution"]["x"]) + 1
+
+    lats = lat1 + np.arange(r_i) * cv_scheme["spatial_resolution"]["y"]
+    longs = long1 + np.arange(r_j) * cv_scheme["spatial_resolution"]["x"]
+    return lats, longs
+
+
+# Dates of a job between t1 and t2, from the timeline of the coverage, or
+# from the series of the point (lat, long) when the server doesn't describe
+# the timeline
+def job_timeline(coverage, series, t1, t2, lat, long, cancel=None):
+    timeline = modis_wtss.coverage_timeline(coverage, cancel)
+    if timeline is not None:
+        [i1, i2] = modis_wtss.timeline_indices(timeline, t1, t2)
+        return timeline[i1:i2]
+    return retrieveDataFromPoint(lat, long, coverage, series, t1, t2, cancel)[0]
+
+
+# The length of the cube comes from the timeline of the coverage, so a series
+# of another length, e.g. from a server missing some composites, is a
+# failure of its pixel instead of an error that stops the whole job
+def series_length_error(data, length):
+    if len(data) != length:
+        return "ValueError('expected %d composites in the timeline of the job, received %d')" % (length, len(data))
+    return None
+
+
+# Creates a cube (rows, columns, time) filled with NaN. With a file name the
+# cube is a .npy file mapped in memory, so areas larger than the RAM can be
+# processed: the pages are written to disk as the values arrive and read
+# back only when they are used.
+def new_cube(shape, file_name=None):
+    if file_name is None:
+        return np.full(shape, np.nan)
+    cube = np.lib.format.open_memmap(file_name, mode="w+", dtype=float, shape=shape)
+    for i in range(0, shape[0], rows_per_block):
+        cube[i:i + rows_per_block] = np.nan
+    return cube
+
+
+# Opens a cube saved on disk by new_cube without loading it
+def open_cube(file_name):
+    return np.load(file_name, mmap_mode="r")
+
+
+# Name of the file of a filtered cube, next to the file of the raw cube and
+# with the same extension (e.g. area.npy and area.mean.npy)
+def companion_file(file_name, name):
+    if file_name is None:
+        return None
+    [base, extension] = os.path.splitext(file_name)
+    return base + "." + name + extension
+
+
+# Checkpoints of the area jobs. A job is split in tiles of tile_size x
+# tile_size pixels; each tile, when complete, is saved in a file of the
+# directory of the job, and the manifest of the job lists the tiles done.
+# The directory is named after a hash of everything that defines the job,
+# so running the same job again finds it and fetches only the missing tiles.
+def area_tiles(r_i, r_j, size):
+    return [(i, min(i + size, r_i), j, min(j + size, r_j))
+            for i in range(0, r_i, size) for j in range(0, r_j, size)]
+
+
+def open_job(job):
+    job_dir = path_join(jobs_dir, hashlib.sha1(json.dumps(job, sort_keys=True).encode()).hexdigest()[:16])
+    os.makedirs(job_dir, exist_ok=True)
+    manifest_file = path_join(job_dir, "manifest.json")
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+    else:
+        manifest = {"job": job, "tiles_done": []}
+        save_manifest(job_dir, manifest)
+    return job_dir, manifest
+
+
+# The files are written under another name and then renamed, so a job
+# interrupted while saving never leaves a truncated tile or manifest
+def save_manifest(job_dir, manifest):
+    with open(path_join(job_dir, "manifest.json.tmp"), "w") as f:
+        json.dump(manifest, f)
+    os.replace(path_join(job_dir, "manifest.json.tmp"), path_join(job_dir, "manifest.json"))
+
+
+def save_tile(job_dir, tile, data, failures):
+    name = path_join(job_dir, "tile_%d_%d.npz" % (tile[0], tile[2]))
+    with open(name + ".tmp", "wb") as f:
+        np.savez(f, data=data, failures=np.asarray(json.dumps(failures)))
+    os.replace(name + ".tmp", name)
+
+
+def load_tile(job_dir, tile):
+    with np.load(path_join(job_dir, "tile_%d_%d.npz" % (tile[0], tile[2]))) as f:
+        return f["data"], json.loads(str(f["failures"]))
+
+
+# Aquisition of a matrix representing an area, covered by one polygon or by
+# a list of polygons. Returns the timeline, an array (rows, columns, time)
+# where pixels outside the polygons are NaN, the list of the pixels that
+# could not be retrieved (also NaN in the array) and the array (rows,
+# columns) with the index of the polygon of each pixel (-1 outside).
+# With cube_file the array is kept on disk in that file (see new_cube). When
+# jobs_dir is set the job is saved tile by tile and resumed if interrupted.
+# progress(done, total) is called, from the thread of the job, each time a
+# pixel arrives; setting the event cancel stops the job with JobCancelled.
+def retrieveDataMatrix(lat1, lat2, long1, long2, t1, t2, coverage, series, polys, out_rem,
+                       percent=default_parameters["percent_outliers_removal"], cube_file=None,
+                       progress=None, cancel=None):
+
+    t = time()
+
+    # Shows info
+    print("------------------------- RETRIEVING " + series.upper() + " DATA --------------------------")
+
+    print("Processing...")
+
+    with modis_metrics.stage("metadata"):
+        # coordinates of the rows and columns of the grid
+        [lats, longs] = area_grid(lat1, lat2, long1, long2, coverage)
+        r_i = len(lats)
+        r_j = len(longs)
+
+        print(r_i, r_j)
+
+        # dates of the job; servers that don't describe the timeline give it
+        # with the series of the center of the area
+        time_series = job_timeline(coverage, series, t1, t2, lat1 + (lat2 - lat1) / 2,
+                                   long1 + (long2 - long1) / 2, cancel)
+
+    # only the pixels inside the polygons are fetched
+    with modis_metrics.stage("labels") as counts:
+        labels = feature_labels(polys, lats, longs)
+        [rows, cols] = np.nonzero(labels >= 0)
+        coord = [[lats[i], longs[j]] for i, j in zip(rows, cols)]
+        counts["items"] = labels.size
+
+    print("%d pixels inside the polygons" % len(coord))
+
+    job_state = {"coverage": coverage, "series": series, "date1": t1, "date2": t2}
+
+    # creates the variable to receive the data, NaN outside the polygon
+    all_data = new_cube((r_i, r_j, len(time_series)), cube_file)
+
+    failures = []
+
+    # without checkpoints the area is a single tile
+    size = max(r_i, r_j) if jobs_dir is None else tile_size
+    tiles = area_tiles(r_i, r_j, size)
+    tiles_done = []
+
+    # pixels of each tile, in the order of tiles
+    tile_of_pixel = (rows // size) * ((r_j + size - 1) // size) + cols // size
+    order = np.argsort(tile_of_pixel, kind="stable")
+    pixels_of_tiles = np.split(order, np.searchsorted(tile_of_pixel[order], np.arange(1, len(tiles))))
+
+    # pixels still to fetch in each tile: all of them, or only the ones that
+    # failed when the tile was retrieved by an interrupted run of the job
+    pending = {tile: tile_pixels for tile, tile_pixels in zip(tiles, pixels_of_tiles)}
+
+    if jobs_dir is not None:
+        job = dict(job_state, server=modis_wtss.wtss_server, bounds=[lat1, lat2, long1, long2],
+                   shape=list(all_data.shape), tile_size=tile_size, pixels=hashlib.sha1(labels.tobytes()).hexdigest())
+        [job_dir, manifest] = open_job(job)
+        tiles_done = [tuple(tile) for tile in manifest["tiles_done"]]
+        pixel_index = np.full(labels.shape, -1)
+        pixel_index[rows, cols] = np.arange(len(rows))
+        n_retries = 0
+        for tile in tiles_done:
+            [data, tile_failures] = load_tile(job_dir, tile)
+            all_data[tile[0]:tile[1], tile[2]:tile[3]] = data
+            pending[tile] = np.array([pixel_index[f["row"], f["col"]] for f in tile_failures], dtype=int)
+            n_retries += len(tile_failures)
+        if len(tiles_done) > 0:
+            print("%d of %d tiles already retrieved, %d pixels to retry" % (len(tiles_done), len(tiles), n_retries))
+
+    tile_failures = {tile: [] for tile in tiles}
+    remaining = {tile: len(pending[tile]) for tile in tiles}
+
+    # a tile is saved as soon as all its pixels arrive; it stays listed as
+    # done even with failures, and the failed pixels are tried again when the
+    # job is resumed
+    def commit_tile(tile):
+        failures.extend(tile_failures[tile])
+        if jobs_dir is not None:
+            save_tile(job_dir, tile, all_data[tile[0]:tile[1], tile[2]:tile[3]], tile_failures[tile])
+            if tile not in tiles_done:
+                manifest["tiles_done"].append(tile)
+                save_manifest(job_dir, manifest)
+
+    for tile in tiles:
+        if remaining[tile] == 0 and tile not in tiles_done:
+            commit_tile(tile)
+
+    # all the pixels to fetch, tile after tile, in a single run of the fetch
+    # engine, so its threads, their connections and the requests in flight
+    # are kept from one tile to the next
+    to_fetch = [(tile, n) for tile in tiles for n in pending[tile]]
+
+    # pixels already retrieved by an interrupted run of the job
+    done = len(coord) - len(to_fetch)
+    assembly = {"items": 0, "bytes": 0, "seconds": 0.}
+
+    # each pixel is written in its place of the cube as soon as it arrives
+    def receive(k, pixel, error):
+        nonlocal done
+        [tile, n] = to_fetch[k]
+        if error is None:
+            error = series_length_error(pixel, all_data.shape[2])
+        if error is not None:
+            tile_failures[tile].append({"row": int(rows[n]), "col": int(cols[n]), "lat": float(coord[n][0]),
+                                        "long": float(coord[n][1]), "feature": int(labels[rows[n], cols[n]]),
+                                        "error": error})
+        else:
+            t_write = perf_counter()
+            all_data[rows[n], cols[n]] = pixel
+            assembly["seconds"] += perf_counter() - t_write
+            assembly["items"] += 1
+            assembly["bytes"] += all_data.itemsize * all_data.shape[2]
+        remaining[tile] -= 1
+        if remaining[tile] == 0:
+            commit_tile(tile)
+        done += 1
+        if progress is not None:
+            progress(done, len(coord))
+
+    with modis_metrics.stage("fetch") as counts:
+        try:
+            fetch_pixels(job_state, [coord[n] for tile, n in to_fetch], receive, cancel=cancel)
+        finally:
+            modis_metrics.add_stage("assembly", assembly["seconds"], assembly["items"], assembly["bytes"])
+        counts["items"] = len(to_fetch)
+        counts["bytes"] = assembly["bytes"]
+
+    # the checkpoints are no longer needed once the whole area is retrieved;
+    # with failures they are kept, so running the job again retries them
+    if jobs_dir is not None and len(failures) == 0:
+        shutil.rmtree(job_dir)
+
+    # failures are listed in the order of the pixels
+    failures.sort(key=lambda f: (f["row"], f["col"]))
+
+    if out_rem:
+        with modis_metrics.stage("outliers") as counts:
+            for i in range(0, r_i, rows_per_block):
+                all_data[i:i + rows_per_block] = remove_outliers(all_data[i:i + rows_per_block], percent, axis=2)
+            counts["items"] = all_data.size
+            counts["bytes"] = all_data.nbytes
+
+    if cube_file is not None:
+        with modis_metrics.stage("assembly"):
+            all_data.flush()
+
+    if len(failures) > 0:
+        print("%d pixels could not be retrieved" % len(failures))
+
+    # print time
+    print("Total time: %.3f minutes" % ((time() - t) / 60))
+
+    return time_series, all_data, failures, labels
+
+
+# Aquisition of the time series of a list of points (batch mode). The points
+# are fetched concurrently by the same engine of the areas. Returns the
+# timeline, an array (points, time) with the series of each point, NaN for
+# the points that could not be retrieved, and the list of these points.
+def retrieveDataPoints(ids, lats, longs, t1, t2, coverage, series, progress=None, cancel=None):
+
+    t = time()
+
+    print("------------------------- RETRIEVING " + series.upper() + " DATA --------------------------")
+    print("%d points" % len(ids))
+
+    with modis_metrics.stage("metadata"):
+        time_series = job_timeline(coverage, series, t1, t2, lats[0], longs[0], cancel)
+
+    job_state = {"coverage": coverage, "series": series, "date1": t1, "date2": t2}
+    coord = list(zip(lats, longs))
+
+    all_data = np.full((len(ids), len(time_series)), np.nan)
+    failures = []
+    done = 0
+    assembly = {"items": 0, "bytes": 0, "seconds": 0.}
+
+    # each series is written in its row as soon as it arrives
+    def receive(n, data, error):
+        nonlocal done
+        if error is None:
+            error = series_length_error(data, all_data.shape[1])
+        if error is not None:
+            failures.append({"point": ids[n], "lat": float(lats[n]), "long": float(longs[n]), "error": error})
+        else:
+            t_write = perf_counter()
+            all_data[n] = data
+            assembly["seconds"] += perf_counter() - t_write
+            assembly["items"] += 1
+            assembly["bytes"] += all_data[n].nbytes
+        done += 1
+        if progress is not None:
+            progress(done, len(ids))
+
+    with modis_metrics.stage("fetch") as counts:
+        fetch_pixels(job_state, coord, receive, cancel=cancel)
+        counts["items"] = len(coord)
+        counts["bytes"] = assembly["bytes"]
+    modis_metrics.add_stage("assembly", assembly["seconds"], assembly["items"], assembly["bytes"])
+
+    # failures are listed in the order of the points
+    order = {point: n for n, point in enumerate(ids)}
+    failures.sort(key=lambda f: order[f["point"]])
+
+    if len(failures) > 0:
+        print("%d points could not be retrieved" % len(failures))
+
+    print("Total time: %.3f minutes" % ((time() - t) / 60))
+
+    return time_series, all_data, failures
+
+
+# Reads the points of a batch job from a CSV file, with the columns lat and
+# long (or latitude and longitude/lon) and, optionally, id or name, or from a
+# GeoJSON file of points (EPSG 4326). Returns the identifiers (the row or
+# feature number when there are none), the latitudes and the longitudes.
+def read_points(file_name):
+    ids = []
+    lats = []
+    longs = []
+
+    if file_name.lower().endswith((".geojson", ".json")):
+        with open(file_name) as f:
+            collection = json.load(f)
+        for n, feature in enumerate(collection["features"]):
+            if feature.get("geometry") is None or feature["geometry"]["type"] != "Point":
+                continue
+            properties = feature.get("properties") or {}
+            ids.append(str(feature.get("id", properties.get("id", properties.get("name", n)))))
+            longs.append(float(feature["geometry"]["coordinates"][0]))
+            lats.append(float(feature["geometry"]["coordinates"][1]))
+    else:
+        with open(file_name, newline="") as f:
+            reader = csv.DictReader(f)
+            names = {name.strip().lower(): name for name in reader.fieldnames}
+            lat_name = names.get("lat", names.get("latitude"))
+            long_name = names.get("long", names.get("lon", names.get("longitude")))
+            id_name = names.get("id", names.get("name"))
+            if lat_name is None or long_name is None:
+                raise ValueError(file_name + " must have the columns lat and long")
+            for n, row in enumerate(reader):
+                ids.append(str(row[id_name]) if id_name is not None else str(n))
+                lats.append(float(row[lat_name]))
+                longs.append(float(row[long_name]))
+
+    if len(ids) == 0:
+        raise ValueError("No points in " + file_name)
+
+    return ids, np.asarray(lats), np.asarray(longs)
+
+
+# Reads all the features of a shapefile (EPSG 4326). Records with several
+# parts and holes become shapely polygons or multipolygons, built from the
+# GeoJSON interface of pyshp in a single pass over the vertices. Returns the
+# list of the geometries and the list of the attributes of each record.
+def read_features(file_name):
+    with modis_metrics.stage("polygons") as counts:
+        sf = shp.Reader(str(file_name)[:-4])
+        polys = []
+        records = []
+
+        for shape_record in sf.shapeRecords():
+            geometry = shape(shape_record.shape.__geo_interface__)
+            if geometry.is_empty:
+                continue
+            polys.append(geometry)
+            records.append(shape_record.record.as_dict())
+
+        counts["items"] = len(polys)
+        counts["bytes"] = modis_metrics.file_size(str(file_name)[:-4] + ".shp")
+
+    return polys, records
+
+
+# Bounding box (long1, lat1, long2, lat2) of a list of polygons
+def features_bounds(polys):
+    bounds = np.asarray([p.bounds for p in polys])
+    return bounds[:, 0].min(), bounds[:, 1].min(), bounds[:, 2].max(), bounds[:, 3].max()
+
+
+#########################################################################
+# - Filtering methods
+#########################################################################
+# Weighted sum of every window of len(mask) consecutive values along the last
+# axis (the "valid" part of the convolution with the reversed mask). The sum
+# runs over the (small) mask, each term being a shifted slice of the whole
+# array, so any number of series is handled at once.
+def window_sum(y, mask):
+    n = y.shape[-1] - len(mask) + 1
+    total = np.zeros(y.shape[:-1] + (n,))
+    for i in range(len(mask)):
+        total += mask[i] * y[..., i:n + i]
+    return total
+
+
+# Applies a convolution mask (odd size, already normalized) to the time
+# series along the given axis, so a whole cube (rows, columns, time) is
+# filtered at once. As in the original filters, the first and last
+# (size-1)/2 values, which the mask can't cover, are kept unchanged.
+def filter_convolution(ts, mask, axis=-1):
+    ts_filtered = np.array(ts, dtype=float)
+    n_p = (len(mask) - 1) // 2
+    n = ts_filtered.shape[axis]
+
+    if n < len(mask):
+        return ts_filtered
+
+    y = np.moveaxis(ts_filtered, axis, -1)
+    y[..., n_p:n - n_p] = window_sum(y, mask)
+
+    return ts_filtered
+
+
+# pyramid filtering method to the time series.
+def filter_pyramid(ts, window_size=default_parameters["window_size_pyramid"], axis=-1):
+    n_p = int((window_size-1)/2)
+
+    # weights 1, 2, ..., n_p+1, ..., 2, 1, whose sum is (n_p+1)^2
+    mask = np.asarray([abs(abs(i) - (n_p + 1)) / ((n_p + 1) ** 2) for i in range(-1 * n_p, n_p + 1)])
+
+    return filter_convolution(ts, mask, axis)
+
+
+# Mean filtering method
+def filter_mean(ts, window_size=default_parameters["window_size_mean"], axis=-1):
+    n_p = int((window_size-1)/2)
+
+    mask = np.ones(2 * n_p + 1) / (2 * n_p + 1)
+
+    return filter_convolution(ts, mask, axis)
+
+
+# Gauss filtering method
+def filter_gauss(time_series, window_size=default_parameters["window_size_GA"],
+                 sigma=default_parameters["sigma_GA"], axis=-1):
+
+    mi = 0
+
+    n_p = int((window_size - 1) / 2)
+
+    # defining the mask
+    mask = np.zeros(2 * n_p + 1)
+    for t in range(-n_p, n_p + 1):
+        mask[t + n_p] = float(
+            (1 / (sigma * math.sqrt(2 * math.pi))) * math.e ** ((-1 / 2) * (((t - mi) ** 2) / sigma ** 2)))
+
+    return filter_convolution(time_series, mask / np.sum(mask), axis)
+
+
+# Coefficients of the Savitzky-Golay filter. They depend only on the
+# parameters of the filter, so they are computed once and kept in a LRU cache.
+# Source: https://scipy-cookbook.readthedocs.io/items/SavitzkyGolay.html
+@lru_cache(maxsize=32)
+def savitzky_golay_coefficients(window_size, order, deriv=0, rate=1):
+    from math import factorial
+
+    try:
+        window_size = abs(int(window_size))
+        order = abs(int(order))
+    except ValueError:
+        print("window_size and order have to be of type int")
+    if window_size % 2 != 1 or window_size < 1:
+        raise TypeError("window_size size must be a positive odd number")
+    if window_size < order + 2:
+        raise TypeError("window_size is too small for the polynomials order")
+    order_range = range(order + 1)
+    half_window = (window_size - 1) // 2
+    b = np.array([[k ** i for i in order_range] for k in range(-half_window, half_window + 1)], dtype=float)
+    m = np.linalg.pinv(b)[deriv] * rate ** deriv * factorial(deriv)
+
+    # the same array is returned to every caller
+    m.setflags(write=False)
+    return m
+
+
+# savitzky golay filtering method.
+# Source: https://scipy-cookbook.readthedocs.io/items/SavitzkyGolay.html
+def filter_savitzky_golay(ts, window_size=default_parameters["window_size_SG"],
+                          order=default_parameters["order_SG"],
+                          deriv=default_parameters["deriv_SG"],
+                          rate=default_parameters["rate_SG"], axis=-1):
+
+    m = savitzky_golay_coefficients(window_size, order, deriv, rate)
+    half_window = (len(m) - 1) // 2
+
+    y = np.moveaxis(np.asarray(ts, dtype=float), axis, -1)
+
+    # pad the signal at the extremes with
+    # values taken from the signal itself
+    firstvals = y[..., :1] - np.abs(y[..., 1:half_window + 1][..., ::-1] - y[..., :1])
+    lastvals = y[..., -1:] + np.abs(y[..., -half_window - 1:-1][..., ::-1] - y[..., -1:])
+    y = np.concatenate((firstvals, y, lastvals), axis=-1)
+
+    return np.moveaxis(window_sum(y, m), -1, axis)
+
+
+# Sparse matrix of the differences of order d, (N-d) x N
+def speyediff(N, d, format='csc'):
+    assert not (d < 0), "d must be non negative"
+    shape = (N - d, N)
+    diagonals = np.zeros(2 * d + 1)
+    diagonals[d] = 1.
+    for i in range(d):
+        diff = diagonals[:-1] - diagonals[1:]
+        diagonals = diff
+    offsets = np.arange(d + 1)
+    spmat = sparse.diags(diagonals, offsets, shape, format=format)
+    return spmat
+
+
+# LU factorization of E + lmbd*D'D used by the Whittaker filter. It depends
+# only on the length of the series, d and lambda, so it is computed once and
+# kept in a LRU cache for the next calls.
+@lru_cache(maxsize=32)
+def whittaker_factorization(m, d, lmbd):
+    E = sparse.eye(m, format='csc')
+    D = speyediff(m, d, format='csc')
+    coefmat = E + lmbd * D.conj().T.dot(D)
+    return splu(coefmat)
+
+
+# Whittaker filtering method.
+# Source: https://github.com/mhvwerts/whittaker-eilers-smoother/blob/master/whittaker_smooth.py
+# All the series of the array are solved together, as the columns of a single
+# multi-right-hand-side system. Series with NaN (e.g. pixels outside the
+# polygon) are returned as NaN.
+def filter_whittaker_eilers(y, window_size=default_parameters["window_size_WT_E"],
+                            lmbd=default_parameters["lmbd_WT_E"], axis=-1):
+
+    d = window_size//2 + 1
+
+    y = np.moveaxis(np.asarray(y, dtype=float), axis, -1)
+    m = y.shape[-1]
+
+    # one series per column
+    columns = y.reshape(-1, m).T
+    valid = np.all(np.isfinite(columns), axis=0)
+
+    z = np.full(columns.shape, np.nan)
+    if np.any(valid):
+        z[:, valid] = whittaker_factorization(m, d, lmbd).solve(np.ascontiguousarray(columns[:, valid]))
+
+    return np.moveaxis(z.T.reshape(y.shape), -1, axis)
+
+
+# Removing outliers
+# Paper: https://www.mdpi.com/2072-4292/5/12/6159
+# A value is replaced by the mean of its neighbors when it is lower than both
+# of them by more than the given percentage. Every series of the array is
+# checked at once along the time axis; NaN values (e.g. pixels outside the
+# polygon) never match the rule and are kept as they are.
+def remove_outliers(ts, percent=default_parameters["percent_outliers_removal"], axis=-1):
+    ts_corrected = np.array(ts, dtype=float)
+    per = percent/100
+
+    y = np.moveaxis(ts_corrected, axis, -1)
+    previous = y[..., :-2]
+    current = y[..., 1:-1]
+    following = y[..., 2:]
+
+    # both are computed before any value is replaced, so the rule is always
+    # applied to the original neighbors
+    outlier = (current - previous < -per * previous) & (current - following < -per * following)
+    interpolated = (previous + following) / 2
+    current[outlier] = interpolated[outlier]
+
+    return ts_corrected
+
+
+# Applies one of the filters of filters_list, by its name, along the time axis
+def apply_filter(name, ts, parameters=default_parameters, axis=-1):
+    if name == "pyramid":
+        return filter_pyramid(ts, parameters["window_size_pyramid"], axis)
+    elif name == "mean":
+        return filter_mean(ts, parameters["window_size_mean"], axis)
+    elif name == "gauss":
+        return filter_gauss(ts, parameters["window_size_GA"], parameters["sigma_GA"], axis)
+    elif name == "SG":
+        return filter_savitzky_golay(ts, parameters["window_size_SG"], parameters["order_SG"],
+                                     parameters["deriv_SG"], parameters["rate_SG"], axis)
+    elif name == "WT_E":
+        return filter_whittaker_eilers(ts, parameters["window_size_WT_E"], parameters["lmbd_WT_E"], axis)
+    raise ValueError("Unknown filter: " + str(name))
+
+
+# Processing of one time series: the outliers removal, if asked, and then
+# the filters. Each stage is computed only when it is first needed and its
+# result is kept, so plotting a series and then saving it (or the other way
+# around) filters it only once. A filter is computed again only when its
+# own parameters change. The results are read-only, as they are shared.
+class FilterPipeline:
+
+    def __init__(self, data_raw, out_rem, percent):
+        self.data_raw = np.array(data_raw, dtype=float)
+        self.data_raw.setflags(write=False)
+        self.out_rem = out_rem
+        self.percent = percent
+        self.wo_outlier = None
+        self.results = {}
+
+    def data_wo_outlier(self):
+        if self.wo_outlier is None:
+            if self.out_rem:
+                self.wo_outlier = remove_outliers(self.data_raw, self.percent)
+                self.wo_outlier.setflags(write=False)
+            else:
+                self.wo_outlier = self.data_raw
+        return self.wo_outlier
+
+    def filtered(self, name, parameters=default_parameters):
+        key = (name,) + tuple(parameters[p] for p in filter_parameters[name])
+        if key not in self.results:
+            result = apply_filter(name, self.data_wo_outlier(), parameters)
+            result.setflags(write=False)
+            self.results[key] = result
+        return self.results[key]
+
+    # Returns the series without outliers and a dict with the selected
+    # filtered series, in the order of filters_list
+    def process(self, filters, parameters=default_parameters):
+        filtered = {}
+        for name, label in filters_list:
+            if name in filters:
+                filtered[name] = self.filtered(name, parameters)
+        return self.data_wo_outlier(), filtered
+
+
+# Pipelines of the last series processed, by a hash of the data and of the
+# outliers removal settings, the most recently used last
+opened_pipelines = OrderedDict()
+pipelines_lock = threading.Lock()
+
+
+def get_pipeline(data_raw, out_rem, percent=default_parameters["percent_outliers_removal"]):
+    data_raw = np.ascontiguousarray(data_raw, dtype=float)
+    key = (hashlib.sha1(data_raw.tobytes()).hexdigest(), len(data_raw), bool(out_rem),
+           percent if out_rem else None)
+    with pipelines_lock:
+        if key in opened_pipelines:
+            opened_pipelines.move_to_end(key)
+        else:
+            opened_pipelines[key] = FilterPipeline(data_raw, out_rem, percent)
+            if len(opened_pipelines) > pipelines_cached:
+                opened_pipelines.popitem(last=False)
+        return opened_pipelines[key]
+
+
+# Raises ValueError when series of n dates are shorter than the window of one
+# of the selected filters, which the filters can't process
+def check_length(n, filters, parameters=default_parameters):
+    for name, label in filters_list:
+        if name in filters:
+            window_size = parameters[filter_parameters[name][0]]
+            if n < window_size:
+                raise ValueError("Time interval shorter than what the filter's window sizes allow: %d dates, "
+                                 "and the window of the %s has %d" % (n, label, window_size))
+
+
+# Removes the outliers, if asked, and applies the selected filters to one
+# time series. Returns the series without outliers and a dict with the
+# filtered series, in the order of filters_list.
+def process_series(data_raw, filters, out_rem, parameters=default_parameters):
+    check_length(len(data_raw), filters, parameters)
+    pipeline = get_pipeline(data_raw, out_rem, parameters["percent_outliers_removal"])
+    return pipeline.process(filters, parameters)
+
+
+# Applies the selected filters to every pixel of an area (rows, columns, time),
+# a block of rows at a time. Returns a dict with the filtered arrays, in the
+# order of filters_list. With cube_file, the file of the raw cube, each
+# filtered array is kept on disk next to it (see companion_file).
+def process_matrix(all_data, filters, parameters=default_parameters, cube_file=None):
+    check_length(all_data.shape[2], filters, parameters)
+    filtered = {}
+    for name, label in filters_list:
+        if name in filters:
+            with modis_metrics.stage("filtering") as counts:
+                filtered[name] = new_cube(all_data.shape, companion_file(cube_file, name))
+                for i in range(0, all_data.shape[0], rows_per_block):
+                    filtered[name][i:i + rows_per_block] = apply_filter(name, all_data[i:i + rows_per_block],
+                                                                        parameters, axis=2)
+                if cube_file is not None:
+                    filtered[name].flush()
+                counts["items"] = all_data.size
+                counts["bytes"] = all_data.nbytes
+
+    return filtered
+
+
+# Removes the outliers, if asked, and applies the selected filters to the
+# series of a batch of points (points, time), all of them at once. Returns
+# the series without outliers and a dict with the filtered series, in the
+# order of filters_list.
+def process_points(all_data, filters, out_rem, parameters=default_parameters):
+    check_length(all_data.shape[1], filters, parameters)
+    data_wo_outlier = all_data
+    if out_rem:
+        with modis_metrics.stage("outliers") as counts:
+            data_wo_outlier = remove_outliers(all_data, parameters["percent_outliers_removal"], axis=1)
+            counts["items"] = all_data.size
+            counts["bytes"] = all_data.nbytes
+
+    filtered = {}
+    for name, label in filters_list:
+        if name in filters:
+            with modis_metrics.stage("filtering") as counts:
+                filtered[name] = apply_filter(name, data_wo_outlier, parameters, axis=1)
+                counts["items"] = all_data.size
+                counts["bytes"] = all_data.nbytes
+
+    return data_wo_outlier, filtered
+
+
+# cos and sin of the angle of each date of a timeline in the year (day of
+# the year * 2 pi / 365). They depend only on the timeline, so they are
+# computed once for each one and kept in a LRU cache.
+@lru_cache(maxsize=32)
+def seasonal_tables(timeline):
+    days = np.asarray([modis_wtss.to_date(t).timetuple().tm_yday for t in timeline], dtype=float)
+    angle = 2 * np.pi * days / 365.0
+    tables = (np.cos(angle), np.sin(angle))
+    for table in tables:
+        table.setflags(write=False)
+    return tables
+
+
+# Polar (seasonal) coordinates of time series: each value is placed at the
+# angle of its day in the year, at a distance equal to the value. Works on
+# any number of series at once (e.g. a whole cube), along the given axis.
+def polar_coordinates(tline, data, axis=-1):
+    [cos, sin] = seasonal_tables(tuple(tline))
+    data = np.moveaxis(np.asarray(data, dtype=float), axis, -1)
+    return np.moveaxis(data * cos, -1, axis), np.moveaxis(data * sin, -1, axis)
+
+
+#########################################################################
+# - Data storage
+#########################################################################
+# Writes a processed time series to a CSV file, with the parameters used in
+# the processing written in the header.
+def save_csv(file_name, tline, data_raw, data_wo_outlier, filtered, out_rem, coverage, series, lat, long,
+             parameters=default_parameters):
+
+    with open(file_name, mode='w') as CSV:
+
+        CSV_writer = csv.writer(CSV, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+
+        # Deals first with the labels
+        CSV_writer.writerow(["Coverage:", coverage, "Series:", series])
+        CSV_writer.writerow(["Latitude:", lat, "Longitude:", long])
+        CSV_writer.writerow([])
+
+        write_parameters(CSV_writer, filtered, out_rem, parameters)
+        CSV_writer.writerow([])
+
+        [names, columns] = series_columns(tline, data_raw, data_wo_outlier, filtered, out_rem)
+        CSV_writer.writerow(names)
+
+        # Writes data itself
+        write_rows(CSV_writer, columns)
+
+
+# Writes the parameters of the outliers removal and of the filters used to
+# the header of a CSV file
+def write_parameters(CSV_writer, filtered, out_rem, parameters=default_parameters):
+    if out_rem:
+        CSV_writer.writerow(["Outliers percentage removal [%]:", parameters["percent_outliers_removal"]])
+    if "pyramid" in filtered:
+        CSV_writer.writerow(["Pyramid filter parameters"])
+        CSV_writer.writerow(["", "Window Size:", parameters["window_size_pyramid"]])
+    if "mean" in filtered:
+        CSV_writer.writerow(["Mean filter parameters"])
+        CSV_writer.writerow(["", "Window Size:", parameters["window_size_mean"]])
+    if "gauss" in filtered:
+        CSV_writer.writerow(["Gauss filter parameters"])
+        CSV_writer.writerow(["", "Window Size:", parameters["window_size_GA"],
+                             "Standard Deviation:", parameters["sigma_GA"]])
+    if "SG" in filtered:
+        CSV_writer.writerow(["Savitzky-Golay filter parameters"])
+        CSV_writer.writerow(["", "Window Size:", parameters["window_size_SG"],
+                             "Polynomial Order:", parameters["order_SG"],
+                             "Derivative Order:", parameters["deriv_SG"],
+                             "Rate:", parameters["rate_SG"]])
+    if "WT_E" in filtered:
+        CSV_writer.writerow(["Whittaker-Eilers filter parameters"])
+        CSV_writer.writerow(["", "Window Size:", parameters["window_size_WT_E"],
+                             "Roughness Penalty:", parameters["lmbd_WT_E"]])
+
+
+# Names and values of the columns of a processed time series, in the order
+# they are saved
+def series_columns(tline, data_raw, data_wo_outlier, filtered, out_rem):
+    names = ["Date", "Data Raw"]
+    columns = [np.asarray([str(t) for t in tline]), np.asarray(data_raw, dtype=float)]
+    if out_rem:
+        names.append("Data Without Outliers")
+        columns.append(np.asarray(data_wo_outlier, dtype=float))
+    for name, label in filters_list:
+        if name in filtered:
+            names.append(label)
+            columns.append(np.asarray(filtered[name], dtype=float))
+    return names, columns
+
+
+# Writes the rows of a set of columns of the same length, csv_rows_per_block
+# rows at a time (the values are converted to Python types a block at once)
+def write_rows(CSV_writer, columns):
+    for i in range(0, len(columns[0]), csv_rows_per_block):
+        CSV_writer.writerows(zip(*[np.asarray(c[i:i + csv_rows_per_block]).tolist() for c in columns]))
+
+
+# Writes a processed time series to a Parquet (.parquet) or Feather
+# (.feather) file. The parameters of the processing are stored in the
+# metadata of the file instead of header rows.
+def save_columnar(file_name, tline, data_raw, data_wo_outlier, filtered, out_rem, coverage, series, lat, long,
+                  parameters=default_parameters):
+    if pyarrow is None:
+        raise ImportError("pyarrow is needed to save Parquet and Feather files")
+
+    [names, columns] = series_columns(tline, data_raw, data_wo_outlier, filtered, out_rem)
+    columns[0] = [datetime.date.fromisoformat(t[:10]) for t in columns[0]]
+
+    metadata = {"coverage": coverage, "series": series, "latitude": str(lat), "longitude": str(long),
+                "outliers_removed": str(bool(out_rem)),
+                "parameters": json.dumps(used_parameters(filtered, out_rem, parameters))}
+    write_columnar(file_name, names, columns, metadata)
+
+
+# Names and values of the columns of a batch of points, one row per point
+# and date
+def points_columns(tline, ids, lats, longs, all_data, data_wo_outlier, filtered, out_rem):
+    [names, columns] = series_columns(tline, all_data.ravel(), data_wo_outlier.ravel(),
+                                      {name: filtered[name].ravel() for name in filtered}, out_rem)
+    n_dates = len(tline)
+    columns[0] = np.tile(columns[0], len(ids))
+    names = ["Point", "Latitude", "Longitude"] + names
+    columns = [np.repeat(np.asarray(ids), n_dates), np.repeat(lats, n_dates), np.repeat(longs, n_dates)] + columns
+    return names, columns
+
+
+# Writes the processed series of a batch of points to a single CSV file, one
+# row per point and date, with the parameters used written in the header.
+# The rows are built and written a block of points at a time, so the memory
+# used does not grow with the number of points.
+def save_points_csv(file_name, tline, ids, lats, longs, all_data, data_wo_outlier, filtered, out_rem, coverage,
+                    series, parameters=default_parameters):
+
+    with open(file_name, mode='w') as CSV:
+
+        CSV_writer = csv.writer(CSV, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+
+        CSV_writer.writerow(["Coverage:", coverage, "Series:", series])
+        CSV_writer.writerow(["Points:", len(ids)])
+        CSV_writer.writerow([])
+
+        write_parameters(CSV_writer, filtered, out_rem, parameters)
+        CSV_writer.writerow([])
+
+        step = max(1, csv_rows_per_block // max(1, len(tline)))
+        for i in range(0, max(1, len(ids)), step):
+            [names, columns] = points_columns(tline, ids[i:i + step], lats[i:i + step], longs[i:i + step],
+                                              all_data[i:i + step], data_wo_outlier[i:i + step],
+                                              {name: filtered[name][i:i + step] for name in filtered}, out_rem)
+            if i == 0:
+                CSV_writer.writerow(names)
+            write_rows(CSV_writer, columns)
+
+
+# Writes the processed series of a batch of points to a single Parquet or
+# Feather file, with the parameters used in the metadata
+def save_points_columnar(file_name, tline, ids, lats, longs, all_data, data_wo_outlier, filtered, out_rem, coverage,
+                         series, parameters=default_parameters):
+    if pyarrow is None:
+        raise ImportError("pyarrow is needed to save Parquet and Feather files")
+
+    [names, columns] = points_columns(tline, ids, lats, longs, all_data, data_wo_outlier, filtered, out_rem)
+    columns[3] = [datetime.date.fromisoformat(t[:10]) for t in columns[3]]
+
+    metadata = {"coverage": coverage, "series": series, "outliers_removed": str(bool(out_rem)),
+                "parameters": json.dumps(used_parameters(filtered, out_rem, parameters))}
+    write_columnar(file_name, names, columns, metadata)
+
+
+# Parameters of the outliers removal and of the filters used
+def used_parameters(filtered, out_rem, parameters=default_parameters):
+    used = []
+    if out_rem:
+        used.append("percent_outliers_removal")
+    for name, label in filters_list:
+        if name in filtered:
+            used.extend(filter_parameters[name])
+    return {p: parameters[p] for p in used}
+
+
+def write_columnar(file_name, names, columns, metadata):
+    table = pyarrow.table(dict(zip(names, columns)), metadata=metadata)
+    if file_name.lower().endswith(".parquet"):
+        parquet.write_table(table, file_name)
+    else:
+        feather.write_feather(table, file_name)
+
+
+# Writes the list of the pixels (or points) that could not be retrieved to a
+# CSV file
+def save_failures(file_name, failures):
+    columns = [(label, key) for label, key in [("Point", "point"), ("Row", "row"), ("Column", "col"),
+                                               ("Latitude", "lat"), ("Longitude", "long"),
+                                               ("Feature", "feature"), ("Error", "error")]
+               if len(failures) > 0 and key in failures[0]]
+    with open(file_name, mode='w') as CSV:
+        CSV_writer = csv.writer(CSV, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        CSV_writer.writerow([label for label, key in columns])
+        for f in failures:
+            CSV_writer.writerow([f[key] for label, key in columns])
+
+
+# Saves an area (the timeline, the raw data, the filtered data and the index
+# of the feature of each pixel, with the attributes of the features in JSON)
+# to a compressed numpy file
+def save_matrix(file_name, tline, all_data, filtered, labels=None, records=None):
+    arrays = {"timeline": np.asarray([str(t) for t in tline]), "raw": all_data}
+    if labels is not None:
+        arrays["labels"] = labels
+    if records is not None:
+        arrays["features"] = np.asarray(json.dumps(records, default=str))
+    for name in filtered:
+        arrays[name] = filtered[name]
+    np.savez_compressed(file_name, **arrays)
+
+
+# Saves an area to a NetCDF file with the dimensions (time, lat, lon): the
+# raw data in the variable "raw", each filtered cube in a variable named
+# after the filter and, if given, the feature of each pixel in "feature"
+# (with the attributes of the features in JSON). The parameters of the
+# processing are global attributes. The variables are compressed in chunks
+# and written a block of rows at a time, so cubes on disk (see new_cube) are
+# never loaded whole in memory.
+def save_netcdf(file_name, tline, lats, longs, all_data, filtered, out_rem, coverage, series,
+                parameters=default_parameters, labels=None, records=None):
+    if netCDF4 is None:
+        raise ImportError("netCDF4 is needed to save NetCDF files")
+
+    with netCDF4.Dataset(file_name, "w") as nc:
+        nc.title = coverage + " " + series + " time series"
+        nc.coverage = coverage
+        nc.series = series
+        nc.outliers_removed = str(bool(out_rem))
+        nc.parameters = json.dumps(used_parameters(filtered, out_rem, parameters))
+
+        nc.createDimension("time", len(tline))
+        nc.createDimension("lat", len(lats))
+        nc.createDimension("lon", len(longs))
+
+        time_var = nc.createVariable("time", "i4", ("time",))
+        time_var.units = "days since 2000-01-01"
+        time_var.calendar = "standard"
+        time_var[:] = [(modis_wtss.to_date(t) - datetime.date(2000, 1, 1)).days for t in tline]
+
+        lat_var = nc.createVariable("lat", "f8", ("lat",))
+        lat_var.units = "degrees_north"
+        lat_var[:] = lats
+        lon_var = nc.createVariable("lon", "f8", ("lon",))
+        lon_var.units = "degrees_east"
+        lon_var[:] = longs
+
+        if labels is not None:
+            feature_var = nc.createVariable("feature", "i4", ("lat", "lon"), zlib=True, fill_value=np.int32(-1))
+            feature_var[:] = labels
+            if records is not None:
+                feature_var.features = json.dumps(records, default=str)
+
+        chunks = (min(len(tline), 64), min(len(lats), 64), min(len(longs), 64))
+        cubes = [("raw", "Raw data", all_data)] + [(name, label, filtered[name])
+                                                  for name, label in filters_list if name in filtered]
+        for name, label, cube in cubes:
+            var = nc.createVariable(name, "f4", ("time", "lat", "lon"), zlib=True, complevel=4,
+                                    chunksizes=chunks, fill_value=np.float32(np.nan))
+            var.long_name = label
+            for i in range(0, cube.shape[0], rows_per_block):
+                var[:, i:i + rows_per_block, :] = np.moveaxis(np.asarray(cube[i:i + rows_per_block]), 2, 0)
+
+
+# Saves an area to GeoTIFF files (EPSG 4326) with one band per date: the raw
+# data in file_name and each filtered cube in a file next to it, named after
+# the filter. The parameters of the processing are tags of the dataset. The
+# files are tiled and compressed, and written a block of rows at a time.
+def save_geotiff(file_name, tline, lats, longs, all_data, filtered, out_rem, coverage, series,
+                 parameters=default_parameters):
+    if rasterio is None:
+        raise ImportError("rasterio is needed to save GeoTIFF files")
+
+    res_y = lats[1] - lats[0] if len(lats) > 1 else 1.
+    res_x = longs[1] - longs[0] if len(longs) > 1 else 1.
+
+    # the rows of the cube go from south to north, the rows of the image
+    # from north to south
+    transform = from_origin(longs[0] - res_x / 2, lats[-1] + res_y / 2, res_x, res_y)
+    r_i = len(lats)
+
+    cubes = [(file_name, all_data)] + [(companion_file(file_name, name), filtered[name])
+                                       for name, label in filters_list if name in filtered]
+    for cube_name, cube in cubes:
+        profile = {"driver": "GTiff", "width": len(longs), "height": r_i, "count": len(tline),
+                   "dtype": "float32", "crs": "EPSG:4326", "transform": transform, "nodata": np.nan,
+                   "tiled": True, "blockxsize": 256, "blockysize": 256, "compress": "deflate",
+                   "interleave": "band", "BIGTIFF": "IF_SAFER"}
+        with rasterio.open(cube_name, "w", **profile) as tif:
+            tif.update_tags(coverage=coverage, series=series, outliers_removed=str(bool(out_rem)),
+                            parameters=json.dumps(used_parameters(filtered, out_rem, parameters)))
+            for k in range(len(tline)):
+                tif.set_band_description(k + 1, str(tline[k]))
+            for i in range(0, r_i, rows_per_block):
+                block = np.asarray(cube[i:i + rows_per_block], dtype=np.float32)[::-1]
+                window = RasterWindow(0, r_i - i - block.shape[0], len(longs), block.shape[0])
+                tif.write(np.moveaxis(block, 2, 0), window=window)
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+# Authors:
+#   Bruno Menini Matosak
+#   Marcos Antônio de Almeida Rodrigues
+#   Tatiana Dias Tardelli Uehara
+
+# Rendering of the animations of area cubes (rows, columns, time) without a
+# display. The frames are drawn on a matplotlib figure with the Agg canvas,
+# not with pyplot, so this module can be used on servers and also by the
+# graphical interface. The cube is downsampled to the size of the animation
+# and rearranged once in the order of the frames, and the color scale is the
+# same for all the frames.
+
+import math
+import os
+import numpy as np
+from matplotlib.animation import FFMpegWriter, PillowWriter
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+import modis_metrics
+
+
+# Largest number of pixels of each side of the rendered frames
+max_size = 512
+
+# Percentiles of the values used as the limits of the color scale, so a few
+# extreme pixels don't wash out the animation
+scale_percentiles = (2, 98)
+
+
+# Frames of the animation of a cube, as an array (time, rows, columns) with
+# each frame contiguous in memory, keeping one pixel of every step in both
+# directions so no side is larger than size. Cubes on disk (see
+# modis_processing.new_cube) are read a block of rows at a time.
+def prepare_frames(cube, size=None):
+    if size is None:
+        size = max_size
+    step = max(1, int(math.ceil(max(cube.shape[0], cube.shape[1]) / float(size))))
+
+    rows = range(0, cube.shape[0], step)
+    frames = np.empty((cube.shape[2], len(rows), len(range(0, cube.shape[1], step))), dtype=np.float32)
+    block = 64 * step
+    for i in range(0, cube.shape[0], block):
+        part = np.asarray(cube[i:i + block:step, ::step, :], dtype=np.float32)
+        frames[:, i // step:i // step + part.shape[0], :] = np.moveaxis(part, 2, 0)
+    return frames
+
+
+# Limits of the color scale of all the frames
+def color_scale(frames):
+    valid = frames[np.isfinite(frames)]
+    if len(valid) == 0:
+        return 0., 1.
+    [vmin, vmax] = np.percentile(valid, scale_percentiles)
+    if vmax <= vmin:
+        vmax = vmin + 1.
+    return float(vmin), float(vmax)
+
+
+# Renders the animation of a cube to file_name: a MP4 video (needs ffmpeg),
+# a GIF, or a sequence of PNG images when file_name is a directory or has no
+# extension (frame_0000.png, frame_0001.png, ...). tline gives the title of
+# each frame.
+def render_animation(file_name, cube, tline=None, title="", fps=10, size=None, cmap="summer", dpi=100):
+    with modis_metrics.stage("rendering") as counts:
+        frames = prepare_frames(cube, size)
+        [vmin, vmax] = color_scale(frames)
+
+        fig = Figure(figsize=(6, 6 * frames.shape[1] / float(max(frames.shape[2], 1)) + 0.8))
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot(1, 1, 1)
+        ax.set_axis_off()
+        im = ax.imshow(frames[0], cmap=cmap, vmin=vmin, vmax=vmax, origin="lower", interpolation="nearest")
+        fig.colorbar(im, ax=ax, shrink=0.8)
+        label = ax.set_title("")
+
+        def draw(k):
+            im.set_data(frames[k])
+            text = str(tline[k]) if tline is not None else "%d" % k
+            label.set_text(title + " " + text if title else text)
+
+        extension = os.path.splitext(file_name)[1].lower()
+        if extension in ("", ".png"):
+            directory = os.path.splitext(file_name)[0]
+            os.makedirs(directory, exist_ok=True)
+            for k in range(frames.shape[0]):
+                draw(k)
+                fig.savefig(os.path.join(directory, "frame_%04d.png" % k), dpi=dpi)
+            counts["items"] = frames.shape[0]
+            counts["bytes"] = modis_metrics.file_size(directory)
+            return directory
+
+        if extension == ".gif":
+            writer = PillowWriter(fps=fps)
+        else:
+            if not FFMpegWriter.isAvailable():
+                raise RuntimeError("ffmpeg is needed to save MP4 videos; save a GIF or PNG images instead")
+            writer = FFMpegWriter(fps=fps)
+        with writer.saving(fig, file_name, dpi):
+            for k in range(frames.shape[0]):
+                draw(k)
+                writer.grab_frame()
+        counts["items"] = frames.shape[0]
+        counts["bytes"] = modis_metrics.file_size(file_name)
+        return file_name
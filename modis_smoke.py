@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+# Authors:
+#   Bruno Menini Matosak
+#   Marcos Antônio de Almeida Rodrigues
+#   Tatiana Dias Tardelli Uehara
+
+# Smoke run of the command-line interface against the local stand-in of the
+# WTSS server (modis_wtss_server.py), without network. It runs the point,
+# points and area modes on a small synthetic input, and checks that each
+# one finishes, writes its output with the dates asked, and that no pixel
+# or point failed. Exits with 1 when any check fails.
+#
+# Example:
+#   python3 modis_smoke.py
+#   python3 modis_smoke.py --error_rate 0.05
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import numpy as np
+import shapefile as shp
+import modis_wtss_server
+
+
+# Dates of the runs: 23 composites per year, so 2 years give 46 dates
+start = "2005-01-01"
+end = "2006-12-31"
+expected_dates = 46
+
+cli = os.path.join(os.path.dirname(os.path.abspath(__file__)), "modis_cli.py")
+
+
+def run_cli(mode, arguments, url):
+    command = [sys.executable, cli, mode, "--server", url, "--series", "ndvi", "--start", start, "--end", end,
+               "--filters", "SG,mean", "--outliers", "--max_attempts", "10"] + arguments
+    return subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+
+
+def write_points(file_name, n_points):
+    with open(file_name, "w") as f:
+        f.write("id,lat,long\n")
+        for n in range(n_points):
+            f.write("p%d,%f,%f\n" % (n, -22.5 - 0.003 * n, -52.2))
+
+
+def write_shapefile(file_name):
+    with shp.Writer(file_name[:-4], shapeType=shp.POLYGON) as w:
+        w.field("name", "C")
+        w.poly([[[-52.22, -22.60], [-52.22, -22.58], [-52.20, -22.58], [-52.20, -22.60], [-52.22, -22.60]]])
+        w.record("square")
+
+
+# Checks of each mode: the output file must have one row of each date (or
+# the cube that many dates) and there must be no failures file
+def check_point(output):
+    with open(output) as f:
+        rows = [line for line in f if line[:4].isdigit()]
+    return len(rows) == expected_dates, "%d dates" % len(rows)
+
+
+def check_points(output, n_points):
+    with open(output) as f:
+        rows = [line for line in f if line.startswith("p")]
+    return len(rows) == expected_dates * n_points, "%d rows of %d points" % (len(rows), n_points)
+
+
+def check_area(output):
+    with np.load(output) as saved:
+        shape = saved["raw"].shape
+        inside = saved["labels"] >= 0
+        missing = int(np.isnan(saved["raw"][inside]).any(axis=-1).sum())
+    return shape[2] == expected_dates and missing == 0, "cube %s, %d pixels missing" % (shape, missing)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Smoke run of modis_cli.py against a local WTSS stand-in")
+    parser.add_argument("--latency", default="0", help="latency of each request of the stand-in, in seconds")
+    parser.add_argument("--error_rate", default="0", help="fraction of the requests of the stand-in that fail")
+    args = parser.parse_args(argv)
+
+    [server, url] = modis_wtss_server.spawn_server("--latency", args.latency, "--error_rate", args.error_rate,
+                                                   "--seed", "0")
+    failed = 0
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            points_file = os.path.join(work_dir, "points.csv")
+            shapefile = os.path.join(work_dir, "area.shp")
+            write_points(points_file, 20)
+            write_shapefile(shapefile)
+
+            runs = [("point", ["--lat", "-22.6", "--long", "-52.2"], "point.csv", check_point),
+                    ("points", ["--points", points_file], "points.csv", lambda output: check_points(output, 20)),
+                    ("area", ["--shapefile", shapefile], "area.npz", check_area)]
+            for mode, arguments, output, check in runs:
+                output = os.path.join(work_dir, output)
+                result = run_cli(mode, arguments + ["-o", output], url)
+                if result.returncode != 0:
+                    [ok, message] = [False, "exit code %d\n%s" % (result.returncode, result.stdout[-2000:])]
+                elif os.path.exists(output + ".failures.csv"):
+                    with open(output + ".failures.csv") as f:
+                        [ok, message] = [False, "failures:\n" + f.read()[-2000:]]
+                else:
+                    [ok, message] = check(output)
+                print("%-4s %-7s %s" % ("OK" if ok else "FAIL", mode, message))
+                failed += 0 if ok else 1
+    finally:
+        server.terminate()
+        server.wait()
+
+    return 1 if failed > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+
+# Authors:
+#   Bruno Menini Matosak
+#   Marcos Antônio de Almeida Rodrigues
+#   Tatiana Dias Tardelli Uehara
+
+# Access to the WTSS server. Each process keeps a single wtss client, and the
+# HTTP connections opened by it are kept alive and reused between requests of
+# the same thread, instead of opening a new connection for every time series.
+# Failed requests are retried a limited number of times, waiting longer after
+# each failure. The descriptions of the coverages (attributes, resolution and
+# timeline) are kept in memory for some time, so they are asked to the server
+# only once. The latency of every attempt is added to the histograms of the
+# current job (see modis_metrics).
+
+import bisect
+import email.utils
+import http.client
+import io
+import os
+import random
+import socket
+import threading
+import time
+import urllib.error
+import urllib.request
+import urllib.response
+import numpy as np
+import wtss
+from modis_cache import to_date
+import modis_metrics
+
+
+# Address of the WTSS server
+wtss_server = "http://www.esensing.dpi.inpe.br"
+
+# Maximum number of attempts of each request
+max_attempts = 5
+
+# The wait before the n-th retry is a random time between 0 and
+# min(backoff_max, backoff_base * 2^(n-1)) seconds
+backoff_base = 1.
+backoff_max = 30.
+
+# Timeout of each request, in seconds
+request_timeout = 60.
+
+# Time, in seconds, the description of a coverage is kept before it is asked
+# to the server again
+coverage_ttl = 6 * 3600.
+
+
+# urllib handler that keeps one persistent HTTP connection per host and per
+# thread. The wtss client reads its answers through urllib, so installing
+# this handler is enough for all its requests to reuse connections.
+class KeepAliveHandler(urllib.request.HTTPHandler):
+
+    def __init__(self):
+        super(KeepAliveHandler, self).__init__()
+        self.local = threading.local()
+
+    @property
+    def connections(self):
+        if not hasattr(self.local, "connections"):
+            self.local.connections = {}
+        return self.local.connections
+
+    def http_open(self, req):
+        headers = dict(req.unredirected_hdrs)
+        headers.update(req.headers)
+        headers["Connection"] = "keep-alive"
+
+        # a connection closed by the server while idle is opened again once
+        for attempt in range(2):
+            connection = self.connections.get(req.host)
+            if connection is None:
+                timeout = req.timeout
+                if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+                    timeout = request_timeout
+                connection = http.client.HTTPConnection(req.host, timeout=timeout)
+                self.connections[req.host] = connection
+
+            try:
+                connection.request(req.get_method(), req.selector, req.data, headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (http.client.HTTPException, OSError) as err:
+                self.close(req.host)
+                if attempt == 1:
+                    raise urllib.error.URLError(err)
+                continue
+
+            if response.will_close:
+                self.close(req.host)
+
+            answer = urllib.response.addinfourl(io.BytesIO(body), response.msg, req.get_full_url(),
+                                                response.status)
+            answer.msg = response.reason
+            return answer
+
+    def close(self, host):
+        connection = self.connections.pop(host, None)
+        if connection is not None:
+            connection.close()
+
+
+# Client of the current process. It is created the first time it is needed
+# and reused for all the following requests.
+opened_client = None
+client_lock = threading.Lock()
+
+
+def get_client():
+    global opened_client
+    with client_lock:
+        if opened_client is None or opened_client[0] != (wtss_server, os.getpid()):
+            urllib.request.install_opener(urllib.request.build_opener(KeepAliveHandler()))
+            opened_client = ((wtss_server, os.getpid()), wtss.wtss(wtss_server))
+    return opened_client[1]
+
+
+# Errors that may not happen again: the network, the timeouts, the errors of
+# the server (5xx) and too many requests (429). The others, such as invalid
+# coordinates or an unknown coverage (400, 404), fail again at every attempt.
+def is_transient(err):
+    if isinstance(err, urllib.error.HTTPError):
+        return err.code == 429 or err.code >= 500
+    return isinstance(err, (urllib.error.URLError, http.client.HTTPException, OSError))
+
+
+# Seconds the server asked to wait before the next request (the Retry-After
+# header of a 429 or 503 answer), or None
+def retry_after(err):
+    if not isinstance(err, urllib.error.HTTPError) or err.headers is None:
+        return None
+    value = err.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0., float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0., when.timestamp() - time.time())
+
+
+# Raised when a job is stopped through its cancel event
+class JobCancelled(Exception):
+    pass
+
+
+# Calls function(*args), trying again when it fails with a transient error,
+# at most max_attempts times. Between attempts it waits the time asked by
+# the server or else an exponential backoff with jitter, so many processes
+# don't hammer the server all at the same moment. When the event cancel is
+# set, no other attempt is made and the wait is cut short (JobCancelled).
+def with_retry(function, *args, cancel=None):
+    operation = function.__name__.replace("request_", "")
+    for attempt in range(max_attempts):
+        if cancel is not None and cancel.is_set():
+            raise JobCancelled()
+        t = time.perf_counter()
+        try:
+            result = function(*args)
+        except Exception as err:
+            modis_metrics.add_request(operation, time.perf_counter() - t, False)
+            if attempt >= max_attempts - 1 or not is_transient(err):
+                raise
+            wait = retry_after(err)
+            if wait is None:
+                wait = random.uniform(0, min(backoff_max, backoff_base * 2 ** attempt))
+            if cancel is None:
+                time.sleep(wait)
+            elif cancel.wait(wait):
+                raise JobCancelled()
+        else:
+            modis_metrics.add_request(operation, time.perf_counter() - t, True)
+            return result
+
+
+def request_time_series(lat, long, coverage, series, date1, date2):
+    ts = get_client().time_series(coverage, series, lat, long, start_date=date1, end_date=date2)
+    return ts.timeline, np.asarray(ts[series], dtype=float)
+
+
+# Downloads the time series of one point from the server
+def downloadDataFromPoint(lat, long, coverage, series, date1, date2, cancel=None):
+    return with_retry(request_time_series, lat, long, coverage, series, date1, date2, cancel=cancel)
+
+
+# Descriptions of the coverages already asked to the server, by server and
+# coverage: the time they were received, the description and its timeline
+described_coverages = {}
+described_lock = threading.Lock()
+
+
+def cached_coverage(coverage, cancel=None):
+    key = (wtss_server, coverage)
+    with described_lock:
+        entry = described_coverages.get(key)
+        if entry is not None and time.time() - entry[0] < coverage_ttl:
+            return entry
+
+    description = with_retry(get_client().describe_coverage, coverage, cancel=cancel)
+    timeline = None
+    if "timeline" in description:
+        timeline = sorted(to_date(t) for t in description["timeline"])
+
+    entry = (time.time(), description, timeline)
+    with described_lock:
+        described_coverages[key] = entry
+    return entry
+
+
+# Description of a coverage (attributes, spatial resolution, ...)
+def describe_coverage(coverage, cancel=None):
+    return cached_coverage(coverage, cancel)[1]
+
+
+# Dates of all the composites of a coverage, in order, or None when the
+# server doesn't list them in the description
+def coverage_timeline(coverage, cancel=None):
+    return cached_coverage(coverage, cancel)[2]
+
+
+# Indices i1, i2 such that timeline[i1:i2] are the dates between date1 and
+# date2 (both included). The timeline is sorted, so a binary search is enough.
+def timeline_indices(timeline, date1, date2):
+    return bisect.bisect_left(timeline, to_date(date1)), bisect.bisect_right(timeline, to_date(date2))
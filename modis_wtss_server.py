@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+
+# Authors:
+#   Bruno Menini Matosak
+#   Marcos Antônio de Almeida Rodrigues
+#   Tatiana Dias Tardelli Uehara
+
+# Local stand-in of the WTSS server, to test and benchmark the retrieval of
+# the data without network. It answers list_coverages, describe_coverage and
+# time_series with the same JSON documents as the WTSS, for the coverages
+# MOD13Q1 and MOD13Q1_M, with synthetic series: a seasonal cycle with noise
+# and clouds, the same for every request of the same pixel. The latency of
+# each request, the fraction of requests that fail and the number of
+# requests per second can be set, to reproduce a slow or unstable server.
+#
+# Examples:
+#   python3 modis_wtss_server.py --port 8080 --latency 0.05 --error_rate 0.02
+#   python3 modis_cli.py point --server http://localhost:8080 --lat -22.6 --long -52.2 --series ndvi -o point.csv
+#
+# It can also be started inside a process, on a free port:
+#   server = modis_wtss_server.start_server(latency=0.01)
+#   modis_wtss.wtss_server = server.url
+
+import argparse
+import bisect
+import datetime
+import json
+import math
+import random
+import subprocess
+import sys
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import numpy as np
+from modis_cache import to_date
+
+
+# Size of the pixels, in degrees (about 250 m)
+spatial_resolution = 0.00208333
+
+# Composites of 16 days, from the first one of MOD13Q1 to the end of 2019
+first_date = datetime.date(2000, 2, 18)
+last_date = datetime.date(2019, 12, 31)
+
+# Attributes of each coverage: (mean, amplitude of the seasonal cycle,
+# standard deviation of the noise, value under clouds), in the scale of the
+# product (10000 = 1)
+coverages = {"MOD13Q1": {"ndvi": (5000, 2500, 300, 1500),
+                         "evi": (3500, 2000, 250, 1000),
+                         "red": (700, -400, 80, 2500),
+                         "nir": (3000, 800, 200, 2700),
+                         "blue": (400, -150, 50, 2000),
+                         "mir": (1500, -500, 150, 2200)},
+             "MOD13Q1_M": {"quality": None,
+                           "reliability": None}}
+
+# Fraction of the composites under clouds
+cloud_fraction = 0.06
+
+
+# Dates of the composites: 23 per year, on the days 1, 17, 33, ... of each year
+def composite_dates():
+    dates = []
+    for year in range(first_date.year, last_date.year + 1):
+        for k in range(23):
+            d = datetime.date(year, 1, 1) + datetime.timedelta(days=16 * k)
+            if first_date <= d <= last_date:
+                dates.append(d)
+    return dates
+
+
+timeline = composite_dates()
+
+
+# Row and column of the pixel of a point, counted from the corner (-180, 90)
+def pixel_of(lat, long):
+    return int(math.floor((90. - lat) / spatial_resolution)), int(math.floor((long + 180.) / spatial_resolution))
+
+
+# Whole series of an attribute at a pixel. The random numbers are seeded by
+# the pixel, so every request of the pixel gets the same values, whatever its
+# dates, and the clouds fall on the same composites for all the attributes.
+def pixel_series(coverage, attribute, row, col):
+    rng = np.random.RandomState(zlib.crc32(("%d,%d" % (row, col)).encode()))
+    phase = rng.uniform(0, 2 * np.pi)
+    clouds = rng.random_sample(len(timeline)) < cloud_fraction
+    noise = rng.standard_normal(len(timeline))
+
+    if coverages[coverage][attribute] is None:
+        # MOD13Q1_M: 0 for good data, 1 or 2 under clouds
+        return np.where(clouds, 1 + (noise > 0), 0).astype(int)
+
+    [mean, amplitude, deviation, cloud] = coverages[coverage][attribute]
+    day = np.array([d.toordinal() for d in timeline], dtype=float)
+    values = mean + amplitude * np.sin(2 * np.pi * day / 365.25 + phase) + deviation * noise
+    values[clouds] = cloud
+    return np.round(values).astype(int)
+
+
+def describe(coverage):
+    return {"name": coverage,
+            "description": "Synthetic " + coverage + " coverage of the local WTSS stand-in",
+            "detail": "",
+            "dimensions": {"x": {"name": "col_id", "min_idx": 0, "max_idx": int(360 / spatial_resolution) - 1},
+                           "y": {"name": "row_id", "min_idx": 0, "max_idx": int(180 / spatial_resolution) - 1},
+                           "t": {"name": "time_id", "min_idx": 0, "max_idx": len(timeline) - 1}},
+            "attributes": [{"name": name, "description": name, "datatype": "int16",
+                            "valid_range": {"min": -2000, "max": 10000}, "scale_factor": 0.0001,
+                            "missing_value": -3000} for name in coverages[coverage]],
+            "spatial_extent": {"xmin": -180., "xmax": 180., "ymin": -90., "ymax": 90.},
+            "spatial_resolution": {"x": spatial_resolution, "y": spatial_resolution},
+            "crs": {"proj4": "+proj=longlat +datum=WGS84 +no_defs ", "wkt": ""},
+            "timeline": [d.isoformat() for d in timeline]}
+
+
+def time_series(coverage, attributes, lat, long, start=None, end=None):
+    i1 = 0 if start is None else bisect.bisect_left(timeline, to_date(start))
+    i2 = len(timeline) if end is None else bisect.bisect_right(timeline, to_date(end))
+    [row, col] = pixel_of(lat, long)
+    return {"query": {"coverage": coverage, "attributes": attributes, "latitude": lat, "longitude": long},
+            "result": {"attributes": [{"attribute": name,
+                                       "values": pixel_series(coverage, name, row, col)[i1:i2].tolist()}
+                                      for name in attributes],
+                       "timeline": [d.isoformat() for d in timeline[i1:i2]],
+                       "coordinates": {"latitude": lat, "longitude": long, "col": col, "row": row}}}
+
+
+# Error of a request, answered with its HTTP status
+class RequestError(Exception):
+
+    def __init__(self, status, message):
+        super(RequestError, self).__init__(message)
+        self.status = status
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+
+    # keeps the connections open between requests, as the WTSS does, and
+    # sends the headers and the body without waiting for the ACK of the client
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        try:
+            self.server.admit()
+            if url.path.endswith("/wtss/list_coverages"):
+                document = {"coverages": sorted(coverages)}
+            elif url.path.endswith("/wtss/describe_coverage"):
+                document = describe(self.coverage(query))
+            elif url.path.endswith("/wtss/time_series"):
+                document = self.time_series(query)
+            else:
+                raise RequestError(404, "unknown operation " + url.path)
+        except RequestError as err:
+            self.answer(err.status, {"exception": str(err)})
+        else:
+            self.answer(200, document)
+
+    def coverage(self, query):
+        name = query.get("name", query.get("coverage"))
+        if name not in coverages:
+            raise RequestError(404, "unknown coverage %r" % name)
+        return name
+
+    def time_series(self, query):
+        coverage = self.coverage(query)
+        attributes = query.get("attributes", "").split(",")
+        for name in attributes:
+            if name not in coverages[coverage]:
+                raise RequestError(400, "unknown attribute %r of %s" % (name, coverage))
+        try:
+            lat = float(query["latitude"])
+            long = float(query["longitude"])
+            if not (-90. <= lat <= 90. and -180. <= long <= 180.):
+                raise ValueError("coordinates out of range")
+            # the wtss client sends start_date and end_date; the older
+            # clients, start and end
+            start = query.get("start_date", query.get("start"))
+            end = query.get("end_date", query.get("end"))
+            return time_series(coverage, attributes, lat, long, start, end)
+        except (KeyError, ValueError) as err:
+            raise RequestError(400, "invalid query: %r" % err)
+
+    def answer(self, status, document):
+        body = json.dumps(document).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if status == 429:
+            self.send_header("Retry-After", "1")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super(StandInHandler, self).log_message(format, *args)
+
+
+# HTTP server of the stand-in. Each request waits latency seconds (plus a
+# random jitter of up to jitter seconds), fails with error 500 with
+# probability error_rate, and when more than rate_limit requests per second
+# arrive (with bursts of up to burst requests) the excess is refused with
+# error 429. Counters of the requests are kept in stats.
+class StandInServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, latency=0., jitter=0., error_rate=0., rate_limit=None, burst=None, seed=None,
+                 verbose=False):
+        super(StandInServer, self).__init__(address, StandInHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.burst = burst if burst is not None else max(1., rate_limit or 1.)
+        self.verbose = verbose
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.tokens = self.burst
+        self.last_refill = time.monotonic()
+        self.stats = {"requests": 0, "errors": 0, "limited": 0}
+
+    @property
+    def url(self):
+        return "http://%s:%d" % self.server_address[:2]
+
+    # Applies the latency, the rate limit and the failures to a request
+    def admit(self):
+        with self.lock:
+            self.stats["requests"] += 1
+            wait = self.latency + self.random.uniform(0, self.jitter)
+            fail = self.random.random() < self.error_rate
+            limited = not self.take_token()
+            if limited:
+                self.stats["limited"] += 1
+            elif fail:
+                self.stats["errors"] += 1
+
+        if wait > 0:
+            time.sleep(wait)
+        if limited:
+            raise RequestError(429, "too many requests")
+        if fail:
+            raise RequestError(500, "injected failure")
+
+    # Token bucket of the rate limit, refilled at rate_limit tokens per second
+    def take_token(self):
+        if self.rate_limit is None:
+            return True
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate_limit)
+        self.last_refill = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+# Starts a stand-in server in a background thread and returns it. With
+# port 0 a free port is used; the address is in server.url. It is stopped
+# with server.shutdown().
+def start_server(host="127.0.0.1", port=0, **options):
+    server = StandInServer((host, port), **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Starts a stand-in server in another process, so it doesn't compete with the
+# client for the interpreter, with the options of the command line (e.g.
+# "--latency", "0.05"). Returns the process and the address of the server.
+def spawn_server(*arguments):
+    process = subprocess.Popen([sys.executable, __file__, "--port", "0"] + list(arguments),
+                               stdout=subprocess.PIPE, universal_newlines=True)
+    url = process.stdout.readline().split()[-1]
+    return process, url
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local stand-in of the WTSS server, with synthetic MOD13Q1 data")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=8080, help="port to listen on")
+    parser.add_argument("--latency", type=float, default=0., help="latency of each request, in seconds")
+    parser.add_argument("--jitter", type=float, default=0.,
+                        help="largest random time added to the latency, in seconds")
+    parser.add_argument("--error_rate", type=float, default=0., help="fraction of the requests that fail")
+    parser.add_argument("--rate_limit", type=float, default=None,
+                        help="largest number of requests per second; the others are refused (429)")
+    parser.add_argument("--burst", type=float, default=None,
+                        help="number of requests accepted at once before the rate limit applies")
+    parser.add_argument("--seed", type=int, default=None, help="seed of the random latencies and failures")
+    parser.add_argument("--verbose", action="store_true", help="log every request")
+    args = parser.parse_args(argv)
+
+    server = StandInServer((args.host, args.port), args.latency, args.jitter, args.error_rate, args.rate_limit,
+                           args.burst, args.seed, args.verbose)
+    print("WTSS stand-in listening on " + server.url)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print("%(requests)d requests, %(errors)d failed, %(limited)d refused by the rate limit" % server.stats)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -9,22 +9,15 @@ import gi
 gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk, GObject, GLib
 import sys
-import wtss
 import datetime
-import csv
-import scipy.sparse as sparse
-from scipy.sparse.linalg import splu
-import math
+import threading
 import os.path as path
-from functools import partial
-from shapely.geometry import shape, Point
-from shapely.geometry.polygon import Polygon
 from time import time
 import matplotlib.animation as animation
 import matplotlib.pyplot as plt
-import multiprocessing as mp
-import numpy as np
-import shapefile as shp
+import modis_processing as proc
+import modis_render
+import modis_wtss
 
 
 # Global parameters for the functions
@@ -51,23 +44,47 @@ sigma_GA = 1
 # Outliers removal
 percent_outliers_removal = 1
 
+# Local cache of the downloaded time series, so the same point and dates are
+# not downloaded again
+proc.set_cache_file(path.join(path.expanduser("~"), ".modis_time_series_cache.sqlite"))
 
-def retrieveDataFromPoint2(lat, long, series, coverage, date1, date2, poly):
-    pt = Point(long, lat)
+# Area jobs are saved tile by tile, so a job interrupted (e.g. by closing the
+# window) continues from where it stopped when it is run again
+proc.set_jobs_dir(path.join(path.expanduser("~"), ".modis_area_jobs"))
 
-    if poly.contains(pt):
-        result = None
-        while result is None:
-            try:
-                w = wtss.wtss("http://www.esensing.dpi.inpe.br")
-                ts = w.time_series(series, coverage, lat, long, start_date=date1, end_date=date2)
 
-                return ts[coverage]
-            except:
-                pass
-        return None
-    else:
-        return None
+# Parameters currently set for the filters, in the form used by modis_processing
+def current_parameters():
+    return {"window_size_pyramid": window_size_pyramid,
+            "window_size_mean": window_size_mean,
+            "window_size_SG": window_size_SG,
+            "order_SG": order_SG,
+            "deriv_SG": deriv_SG,
+            "rate_SG": rate_SG,
+            "window_size_WT_E": window_size_WT_E,
+            "lmbd_WT_E": lmbd_WT_E,
+            "window_size_GA": window_size_GA,
+            "sigma_GA": sigma_GA,
+            "percent_outliers_removal": percent_outliers_removal}
+
+
+# Names of the filters selected by the check buttons
+def selected_filters(f_pyramid, f_mean, f_gauss, f_SG, f_WT_E):
+    f_filters = []
+    for name, active in [("pyramid", f_pyramid), ("mean", f_mean), ("gauss", f_gauss),
+                         ("SG", f_SG), ("WT_E", f_WT_E)]:
+        if active:
+            f_filters.append(name)
+    return f_filters
+
+
+# Color of each filter in the graphs
+filter_colors = {"pyramid": "red",
+                 "mean": "blue",
+                 "gauss": "orange",
+                 "SG": "green",
+                 "WT_E": "purple"}
+
 
 class Window(Gtk.ApplicationWindow):
     #########################################################################
@@ -169,12 +186,8 @@ class Window(Gtk.ApplicationWindow):
         self.entry_long.set_text("-52.221069")
 
         # Series entry
+        # (filled with the attributes of the coverage by load_series)
         list_of_series = Gtk.ListStore(str)
-        w = wtss.wtss("http://www.esensing.dpi.inpe.br")
-        cv_scheme = w.describe_coverage(cov)
-        series = list(cv_scheme["attributes"].keys())
-        for serie in series:
-            list_of_series.append([serie])
         self.ser_combo = Gtk.ComboBox.new_with_model(list_of_series)
         renderer_text = Gtk.CellRendererText()
         self.ser_combo.pack_start(renderer_text, True)
@@ -222,8 +235,9 @@ class Window(Gtk.ApplicationWindow):
 
         self.frame_filters.add(hbox)
 
-        # Info label
+        # Info label, also used for the progress of the jobs
         self.info = Gtk.Label()
+        self.pb = self.info
 
         # Outliers check button
         self.check_outlier = Gtk.CheckButton()
@@ -255,6 +269,12 @@ class Window(Gtk.ApplicationWindow):
         self.button_save.connect("clicked", self.on_button_clicked, cov, "save")
         self.button_save.set_property("height-request", 0.5)
 
+        # Cancel button
+        self.button_cancel = Gtk.Button(label="Cancel")
+        self.button_cancel.connect("clicked", self.on_button_clicked_cancel)
+        self.button_cancel.set_sensitive(False)
+        self.process_buttons = [self.button, self.button_save]
+
         ##### Adicionando os grids #####
         self.grid.attach(Gtk.Label("Lat: "), 0, 1, 1, 1)
         self.grid.attach(self.entry_lat, 1, 1, 1, 1)
@@ -284,6 +304,7 @@ class Window(Gtk.ApplicationWindow):
 
         self.grid.attach(self.button, 1, 10, 1, 1)
         self.grid.attach(self.button_save, 1, 11, 1, 1)
+        self.grid.attach(self.button_cancel, 1, 12, 1, 1)
         self.grid.attach_next_to(self.info, self.button, Gtk.PositionType.TOP, 1, 1)
         self.grid.set_row_spacing(6)
         self.grid.set_column_spacing(6)
@@ -292,6 +313,8 @@ class Window(Gtk.ApplicationWindow):
 
         self.show_all()
 
+        self.load_series(cov)
+
     # Things the program do after clicking the button "Process" in the window of the parameters selection
     def on_button_clicked(self, widget, coverage, action):
 
@@ -310,42 +333,16 @@ class Window(Gtk.ApplicationWindow):
                     print((date2-date1).days)
                     int('a')
 
-                # Calls the raw data
-                [ti_se, dados] = self.retrieveDataFromPoint(float(self.entry_lat.get_text()),
-                                                            float(self.entry_long.get_text()),
-                                                            coverage,
-                                                            serie,
-                                                            self.entry_s_date.get_text(),
-                                                            self.entry_e_date.get_text())
-
-                if action == "save":
-                    self.get_file( ti_se,
-                                   dados,
-                                   self.check_pyramid.get_active(),
-                                   self.check_mean.get_active(),
-                                   self.check_gauss.get_active(),
-                                   self.check_outlier.get_active(),
-                                   self.check_SG.get_active(),
-                                   self.check_WT_E.get_active(),
-                                   coverage,
-                                   serie,
-                                   self.entry_lat.get_text(),
-                                   self.entry_long.get_text())
-                elif action == "graph":
-                    # Calls the funcion to filter if selected and plot the graph
-                    self.showGraphFiltered(ti_se,
-                                           dados,
-                                           self.check_pyramid.get_active(),
-                                           self.check_mean.get_active(),
-                                           self.check_gauss.get_active(),
-                                           self.check_outlier.get_active(),
-                                           self.check_SG.get_active(),
-                                           self.check_WT_E.get_active(),
+                # Calls the raw data, in background
+                self.retrieveDataFromPoint(float(self.entry_lat.get_text()),
+                                           float(self.entry_long.get_text()),
+                                           coverage,
                                            serie,
+                                           self.entry_s_date.get_text(),
+                                           self.entry_e_date.get_text(),
+                                           action,
                                            self.graph_type_combo.get_model()[tree_iter2][0])
 
-
-
             except ValueError:
                 message = "Input data inserted incorrectly."
 
@@ -399,12 +396,8 @@ class Window(Gtk.ApplicationWindow):
         self.button_shp.connect("clicked", self.on_button_clicked_shp)
 
         # Series entry
+        # (filled with the attributes of the coverage by load_series)
         list_of_series = Gtk.ListStore(str)
-        w = wtss.wtss("http://www.esensing.dpi.inpe.br")
-        cv_scheme = w.describe_coverage(cov)
-        series = list(cv_scheme["attributes"].keys())
-        for serie in series:
-            list_of_series.append([serie])
         self.ser_combo = Gtk.ComboBox.new_with_model(list_of_series)
         renderer_text = Gtk.CellRendererText()
         self.ser_combo.pack_start(renderer_text, True)
@@ -434,6 +427,18 @@ class Window(Gtk.ApplicationWindow):
         self.button = Gtk.Button(label="Process")
         self.button.connect("clicked", self.on_button_clicked_timelapse)
 
+        # Cancel button
+        self.button_cancel = Gtk.Button(label="Cancel")
+        self.button_cancel.connect("clicked", self.on_button_clicked_cancel)
+        self.button_cancel.set_sensitive(False)
+
+        # Save button, available once an area is processed
+        self.area = None
+        self.button_save_area = Gtk.Button(label="Save area")
+        self.button_save_area.connect("clicked", self.on_button_clicked_save_area)
+        self.button_save_area.set_sensitive(False)
+        self.process_buttons = [self.button, self.button_save_area]
+
         # Progressbar
         self.pb = Gtk.Label(" ")
 
@@ -459,11 +464,12 @@ class Window(Gtk.ApplicationWindow):
         self.grid.attach(self.pb, 0, 10, 2, 1)
 
         self.grid.attach(self.button, 1, 12, 1, 1)
+        self.grid.attach(self.button_cancel, 1, 13, 1, 1)
+        self.grid.attach(self.button_save_area, 1, 14, 1, 1)
         self.grid.set_row_spacing(6)
         self.grid.set_column_spacing(6)
 
         info = Gtk.Label("\nWARNING: It is recommended to use shapefiles"
-                         "\nwith a single polygon with a few vertices in it,"
                          "\nof small areas."
                          "\nReference system EPSG 4326.\n")
         self.grid.attach_next_to(info, self.ser_combo, Gtk.PositionType.TOP, 2, 1)
@@ -472,6 +478,8 @@ class Window(Gtk.ApplicationWindow):
 
         self.show_all()
 
+        self.load_series(cov)
+
     # Bindings to call the area animation
     def on_button_clicked_timelapse(self, args):
         tree_iter = self.ser_combo.get_active_iter()
@@ -488,27 +496,17 @@ class Window(Gtk.ApplicationWindow):
                 if not path.exists(str(self.entry_shp.get_text())) or str(self.entry_shp.get_text()) is None:
                     int('a')
 
-                sf = shp.Reader(str(self.entry_shp.get_text())[:-4])
-                n = 0
-                matplotDict = []
-
-                for shape in sf.shapeRecords():  # Iterate through shapes in shapefile
-                    x = [i[0] for i in shape.shape.points[:]]  # Initially for use in matplotlib to check shapefile
-                    y = [i[1] for i in shape.shape.points[:]]  # Initially for use in matplotlib to check shapefile
-                    for i in x:
-                        matplotDict.append(
-                            (x[x.index(i)], y[x.index(i)]))  # Convert coordinates to be read by Shapely pkg
+                [polys, records] = proc.read_features(str(self.entry_shp.get_text()))
+                [long1, lat1, long2, lat2] = proc.features_bounds(polys)
 
-                    poly = Polygon(matplotDict)  # main
-                    n += 1
-
-                self.callMapAnimation(x,
-                                      y,
+                self.callMapAnimation([long1, long2],
+                                      [lat1, lat2],
                                       str(self.entry_s_date.get_text()),
                                       str(self.entry_e_date.get_text()),
                                       "MOD13Q1",
                                       serie,
-                                      poly,
+                                      polys,
+                                      records,
                                       self.check_outlier.get_active())
 
             except ValueError:
@@ -570,19 +568,102 @@ class Window(Gtk.ApplicationWindow):
     #########################################################################
     # - Data retrieval and storage
     #########################################################################
-    # Gets the needed data from the server
-    def retrieveDataFromPoint(self, lat, long, series, coverage, date1, date2):
-        w = wtss.wtss("http://www.esensing.dpi.inpe.br")
-        ts = w.time_series(series, coverage, lat, long, start_date=date1, end_date=date2)
-        if len(ts[coverage]) < window_size_mean or (len(ts[coverage]) < window_size_pyramid or (
-                len(ts[coverage]) < window_size_GA or (
-                len(ts[coverage]) < window_size_SG or len(ts[coverage]) < window_size_WT_E))):
+    # Runs work(cancel) in a background thread, so the window keeps responding,
+    # and then done(result, *args) in the Gtk main loop. cancel is the event
+    # set by the Cancel button; the result of a job cancelled in the meantime
+    # is discarded.
+    def run_in_background(self, work, done, *args):
+        cancel = self.cancel_event = threading.Event()
+        self.set_busy(True)
+
+        def run():
+            try:
+                result = work(cancel)
+            except Exception as err:
+                GLib.idle_add(self.background_failed, err)
+                return
+            if cancel.is_set():
+                GLib.idle_add(self.background_failed, proc.JobCancelled())
+            else:
+                GLib.idle_add(self.background_finished, done, result, *args)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def background_finished(self, done, result, *args):
+        self.set_busy(False)
+        done(result, *args)
+
+    def background_failed(self, err):
+        self.set_busy(False)
+        if isinstance(err, proc.JobCancelled):
+            self.pb.set_text("Processing cancelled.")
+        else:
+            self.pb.set_text("")
+            self.error_message("Error", "The data could not be retrieved:\n" + str(err))
+
+    # Fills the combo box of the series with the attributes of the coverage.
+    # They are asked to the server in background, so the form opens at once
+    # and an unreachable server is reported instead of freezing the window.
+    def load_series(self, cov):
+        self.pb.set_text("Loading the series of " + cov + "...")
+        self.run_in_background(lambda cancel: modis_wtss.describe_coverage(cov, cancel), self.series_loaded,
+                               self.ser_combo)
+
+    def series_loaded(self, cv_scheme, combo):
+        self.pb.set_text("")
+        for serie in cv_scheme["attributes"].keys():
+            combo.get_model().append([serie])
+
+    # Disables the buttons of the form while a job runs, except Cancel
+    def set_busy(self, busy):
+        for button in self.process_buttons:
+            button.set_sensitive(not busy)
+        self.button.set_label("Processing..." if busy else "Process")
+        self.button_cancel.set_sensitive(busy)
+
+    def on_button_clicked_cancel(self, widget):
+        self.cancel_event.set()
+        self.button_cancel.set_sensitive(False)
+
+    # Gets the needed data from the server and filters it in background, then
+    # plots it or saves it
+    def retrieveDataFromPoint(self, lat, long, coverage, series, date1, date2, action, graph_type):
+        self.pb.set_text("")
+
+        # the options are read here, as the widgets can't be used by the thread
+        filters = selected_filters(self.check_pyramid.get_active(), self.check_mean.get_active(),
+                                   self.check_gauss.get_active(), self.check_SG.get_active(),
+                                   self.check_WT_E.get_active())
+        out_rem = self.check_outlier.get_active()
+        parameters = current_parameters()
+
+        def work(cancel):
+            [ti_se, dados] = proc.retrieveDataFromPoint(lat, long, coverage, series, date1, date2, cancel=cancel)
+            try:
+                proc.check_length(len(dados), filters, parameters)
+            except ValueError:
+                return ti_se, dados, None
+            return ti_se, dados, proc.process_series(dados, filters, out_rem, parameters)
+
+        self.run_in_background(work, self.point_retrieved, lat, long, coverage, series, out_rem, parameters,
+                               action, graph_type)
+
+    def point_retrieved(self, result, lat, long, coverage, series, out_rem, parameters, action, graph_type):
+        [ti_se, dados, processed] = result
+        if processed is None:
             self.warning("Error", "Time interval shorter than what the filter's window sizes allow.")
-            return None
-        return ts.timeline, ts[coverage]
+            return
+        [data_wo_outlier, filtered] = processed
+
+        if action == "save":
+            self.get_file(ti_se, dados, data_wo_outlier, filtered, out_rem, parameters, coverage, series, str(lat),
+                          str(long))
+        elif action == "graph":
+            # Plots the series and the selected filters
+            self.showGraphFiltered(ti_se, dados, data_wo_outlier, filtered, out_rem, series, graph_type)
 
     # Opens a dialog so the user can choose a file to save the data
-    def get_file(self, tline, data_raw, f_pyramid, f_mean, f_gauss, f_outlier, f_SG, f_WT_E, coverage, series,
+    def get_file(self, tline, data_raw, data_wo_outlier, filtered, f_outlier, parameters, coverage, series,
                      lat, long):
 
             # create a filechooserdialog to save:
@@ -598,14 +679,14 @@ class Window(Gtk.ApplicationWindow):
             # dialog always on top of the textview window
             save_dialog.set_modal(True)
             # connect the dialog to the callback function save_response_cb()
-            save_dialog.connect("response", self.save_data, tline, data_raw, f_pyramid, f_mean, f_gauss, f_outlier,
-                                f_SG, f_WT_E, coverage, series, lat, long)
+            save_dialog.connect("response", self.save_data, tline, data_raw, data_wo_outlier, filtered, f_outlier,
+                                parameters, coverage, series, lat, long)
             # show the dialog
             save_dialog.show()
 
-    # Process and save data
-    def save_data(self, dialog, response_id, tline, data_raw, f_pyramid, f_mean, f_gauss, f_outlier, f_SG,
-                          f_WT_E, coverage, series, lat, long):
+    # Saves the data, already processed in background
+    def save_data(self, dialog, response_id, tline, data_raw, data_wo_outlier, filtered, f_outlier, parameters,
+                          coverage, series, lat, long):
 
                 save_dialog = dialog
                 # if response is "ACCEPT" (the button "Save" has been clicked)
@@ -616,187 +697,13 @@ class Window(Gtk.ApplicationWindow):
                     if file_name[-4:] != ".csv" and file_name[-4:] != ".CSV":
                         file_name = file_name + ".csv"
 
-                    # Prepares data to print in polar
-                    def polar(tline, data_raw):
-                        jdates = tline.copy()
-                        # julian days
-                        for i in range(len(jdates)):
-                            jdates[i] = (
-                                datetime.datetime.combine(jdates[i], datetime.datetime.min.time())).timetuple().tm_yday
-                        jdates = np.asarray(jdates).astype(np.float)
-                        a = jdates.copy()
-                        o = jdates.copy()
-                        for i in range(len(jdates)):
-                            a[i] = float(data_raw[i] * np.cos(2 * np.pi * jdates[i] / 365.0))
-                            o[i] = float(data_raw[i] * np.sin(2 * np.pi * jdates[i] / 365.0))
-                        return a, o
-
-                    data_wo_outlier = data_raw.copy()
-
-                    # Plot a line with outlier removed
-                    if f_outlier:
-                        data_wo_outlier = self.remove_outliers(data_wo_outlier)
-
-                    # Plot if pyramid filter selected
-                    if f_pyramid:
-                        data_pyramid = self.filter_pyramid(data_wo_outlier)
-
-                    # plot if mean filter selected
-                    if f_mean:
-                        data_filter_mean = self.filter_mean(data_wo_outlier)
-
-                    # plot if mean filter selected
-                    if f_gauss:
-                        data_filter_gauss = self.filter_gauss(data_wo_outlier)
-
-                    # plot if Savitzky-Golay selected
-                    if f_SG:
-                        data_SG = self.filter_savitzky_golay(data_wo_outlier)
-
-                    if f_WT_E:
-                        data_WT_E = self.filter_whittaker_eilers(data_wo_outlier)
-
                     # Opens the CSV file, and writes data
-                    with open(file_name, mode='w') as CSV:
-
-                        CSV_writer = csv.writer(CSV, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-
-                        # Deals first with the labels
-                        list = []
-
-                        list.append("Coverage:")
-                        list.append(coverage)
-                        list.append("Series:")
-                        list.append(series)
-                        CSV_writer.writerow(list)
-
-                        list = []
-
-                        list.append("Latitude:")
-                        list.append(lat)
-                        list.append("Longitude:")
-                        list.append(long)
-                        CSV_writer.writerow(list)
-
-                        list = []
-                        CSV_writer.writerow(list)
-
-                        if f_outlier:
-                            list = []
-                            list.append("Outliers percentage removal [%]:")
-                            global percent_outliers_removal
-                            list.append(percent_outliers_removal)
-                            CSV_writer.writerow(list)
-                        if f_pyramid:
-                            list = []
-                            list.append("Pyramid filter parameters")
-                            CSV_writer.writerow(list)
-                            list = []
-                            list.append("")
-                            list.append("Window Size:")
-                            global window_size_pyramid
-                            list.append(window_size_pyramid)
-                            CSV_writer.writerow(list)
-                        if f_mean:
-                            list = []
-                            list.append("Mean filter parameters")
-                            CSV_writer.writerow(list)
-                            list = []
-                            list.append("")
-                            list.append("Window Size:")
-                            global window_size_mean
-                            list.append(window_size_mean)
-                            CSV_writer.writerow(list)
-                        if f_gauss:
-                            list = []
-                            list.append("Gauss filter parameters")
-                            CSV_writer.writerow(list)
-                            list = []
-                            list.append("")
-                            list.append("Window Size:")
-                            global window_size_GA
-                            list.append(window_size_mean)
-                            list.append("Standard Deviation:")
-                            global sigma_GA
-                            list.append(sigma_GA)
-                            CSV_writer.writerow(list)
-                        if f_SG:
-                            list = []
-                            list.append("Savitzky-Golay filter parameters")
-                            CSV_writer.writerow(list)
-                            list = []
-                            list.append("")
-                            global window_size_SG
-                            global order_SG
-                            global deriv_SG
-                            global rate_SG
-                            list.append("Window Size:")
-                            list.append(window_size_SG)
-                            list.append("Polynomial Order:")
-                            list.append(order_SG)
-                            list.append("Derivative Order:")
-                            list.append(deriv_SG)
-                            list.append("Rate:")
-                            list.append(rate_SG)
-                            CSV_writer.writerow(list)
-                        if f_WT_E:
-                            list = []
-                            list.append("Whittaker-Eilers filter parameters")
-                            CSV_writer.writerow(list)
-                            list = []
-                            list.append("")
-                            global window_size_WT_E
-                            global lmbd_WT_E
-                            list.append("Window Size:")
-                            list.append(window_size_WT_E)
-                            list.append("Roughness Penalty:")
-                            list.append(order_SG)
-                            CSV_writer.writerow(list)
-
-                        list = []
-                        CSV_writer.writerow(list)
-
-                        list.append("Date")
-                        list.append("Data Raw")
-                        if f_outlier:
-                            list.append("Data Without Outliers")
-                        if f_pyramid:
-                            list.append("Pyramid Filter")
-                        if f_mean:
-                            list.append("Mean Filter")
-                        if f_gauss:
-                            list.append("Gauss Filter")
-                        if f_SG:
-                            list.append("Savitzky-Golay Filter")
-                        if f_WT_E:
-                            list.append("Wittaker-Eilers Filter")
-
-                        CSV_writer.writerow(list)
-
-                        # Writes data itself
-                        for i in range(len(tline)):
-                            list = []
-
-                            list.append(tline[i])
-                            list.append((data_raw[i]))
-
-                            if f_outlier:
-                                list.append(data_wo_outlier[i])
-                            if f_pyramid:
-                                list.append(data_pyramid[i])
-                            if f_mean:
-                                list.append(data_filter_mean[i])
-                            if f_gauss:
-                                list.append(data_filter_gauss[i])
-                            if f_SG:
-                                list.append(data_SG[i])
-                            if f_WT_E:
-                                list.append(data_WT_E[i])
-
-                            CSV_writer.writerow(list)
-                        # destroy the FileChooserDialog
-                        dialog.destroy()
-                        self.warning("Save to CSV complete", "Your file were stored in " + file_name)
+                    proc.save_csv(file_name, tline, data_raw, data_wo_outlier, filtered, f_outlier,
+                                  coverage, series, lat, long, parameters)
+
+                    # destroy the FileChooserDialog
+                    dialog.destroy()
+                    self.warning("Save to CSV complete", "Your file were stored in " + file_name)
 
                 # if response is "CANCEL" (the button "Cancel" has been clicked)
                 elif response_id == Gtk.ResponseType.CANCEL:
@@ -805,106 +712,108 @@ class Window(Gtk.ApplicationWindow):
                 else:
                     dialog.destroy()
 
-    # Aquisition of a matrix representing an area
-    def retrieveDataMatrix(self, lat1, lat2, long1, long2, t1, t2, series, coverage, poly, out_rem):
-
-        self.pb.set_text("")
-        self.button.set_label("Processing...")
-        self.button.set_sensitive(False)
-        while Gtk.events_pending():
-            Gtk.main_iteration()
-
-        t = time()
-
-        # Shows info
-        print("------------------------- RETRIEVING " + coverage.upper() + " DATA --------------------------")
+    # Aquisition of a matrix representing an area, in background. The progress
+    # (pixels done, throughput and time left) is shown while the job runs.
+    def retrieveDataMatrix(self, lat1, lat2, long1, long2, t1, t2, coverage, series, polys, records, out_rem):
 
-        print("Processing...")
+        self.pb.set_text("Starting...")
 
-        # server data
-        w = wtss.wtss("http://www.esensing.dpi.inpe.br")
+        # the parameters of the job, saved with the area even if the settings
+        # change before it is saved
+        parameters = current_parameters()
 
-        # gets coverage info
-        cv_scheme = w.describe_coverage(series)
-
-        # range i (height) and j (width) based on the spatial resolution
-        r_i = int((lat2 - lat1) / cv_scheme["spatial_resolution"]["y"]) + 1
-        r_j = int((long2 - long1) / cv_scheme["spatial_resolution"]["x"]) + 1
-
-        print(r_i, r_j)
-
-        # print info about the n° of lines and column, as well as an estimative for the time needed to do everything
-        y = (lat1 + (lat2 - lat1) / 2)
-        x = (long1 + (long2 - long1) / 2)
-        [time_series, data] = self.retrieveDataFromPoint(y, x, series, coverage, t1, t2)
-
-        coord = []
-
-        # loop that creates the iterations indexes
-        for i in range(r_i):
-            for j in range(r_j):
-                y = lat1 + i * cv_scheme["spatial_resolution"]["y"]
-                x = long1 + j * cv_scheme["spatial_resolution"]["x"]
-
-                coord.append([y, x])
+        t = time()
+        shown = {"time": 0., "first": None}
+
+        # called by the job for each pixel; the label is updated a few times
+        # per second, in the main loop
+        def progress(done, total):
+            if shown["first"] is None:
+                shown["first"] = done - 1
+            if time() - shown["time"] > 0.25 or done == total:
+                shown["time"] = time()
+                GLib.idle_add(self.show_progress, done, total, done - shown["first"], time() - t)
+
+        def work(cancel):
+            return proc.retrieveDataMatrix(lat1, lat2, long1, long2, t1, t2, coverage, series, polys, out_rem,
+                                           parameters["percent_outliers_removal"], progress=progress,
+                                           cancel=cancel)
+
+        self.run_in_background(work, self.matrix_retrieved, t, [lat1, lat2, long1, long2], coverage, series,
+                               records, out_rem, parameters)
+
+    def show_progress(self, done, total, done_now, elapsed):
+        if self.cancel_event.is_set():
+            return
+        rate = done_now / max(elapsed, 1e-6)
+        message = "%d of %d pixels (%.1f pixels/s)" % (done, total, rate)
+        if rate > 0 and done < total:
+            message = message + "\nAbout %.1f minutes left" % ((total - done) / rate / 60)
+        self.pb.set_text(message)
+
+    def matrix_retrieved(self, result, t, bounds, coverage, series, records, out_rem, parameters):
+        [time_series, all_data, failures, labels] = result
+
+        message = "Total processing time: %.3f minutes" % ((time() - t) / 60)
+        if len(failures) > 0:
+            message = message + "\n%d pixels could not be retrieved." % len(failures)
+        self.pb.set_text(message)
 
-        with mp.Pool(processes=mp.cpu_count()) as pool:
-            data = pool.starmap(partial(retrieveDataFromPoint2),
-                                [(lat, long, series, coverage, t1, t2, poly) for (lat, long) in coord])
+        self.ts = time_series
+        self.all = all_data
+        self.i = all_data.shape[0]
+        self.j = all_data.shape[1]
 
-        print("data type:", type(data))
+        # kept so the area can be saved
+        [lats, longs] = proc.area_grid(bounds[0], bounds[1], bounds[2], bounds[3], coverage)
+        self.area = (time_series, lats, longs, all_data, labels, records, coverage, series, out_rem, parameters)
+        self.button_save_area.set_sensitive(True)
 
-        # creates the variable to receive the data
-        all_data = np.zeros((r_i, r_j, len(time_series)))
+        self.showMapAnimation()
 
-        for i in range(r_i):
-            for j in range(r_j):
-                if data[i * r_j + j] == None:
-                    all_data[i, j, :] = None
-                else:
-                    for k in range(all_data.shape[2]):
-                        all_data[i, j, k] = data[i * r_j + j][k]
+    # Saves the last area processed, in the format given by the extension of
+    # the file: NetCDF (.nc), GeoTIFF (.tif) or numpy (.npz)
+    def on_button_clicked_save_area(self, widget):
+        if self.area is None:
+            self.warning("Warning", "Please process an area first.")
+            return
 
-        if out_rem:
-            for i in range(r_i):
-                for j in range(r_j):
-                    all_data[i,j,:] = self.remove_outliers(all_data[i,j,:])
+        dialog = Gtk.FileChooserDialog("Save area", self,
+                                       Gtk.FileChooserAction.SAVE,
+                                       (Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL,
+                                        Gtk.STOCK_SAVE, Gtk.ResponseType.ACCEPT))
+        dialog.set_do_overwrite_confirmation(True)
+        dialog.set_current_name("area.nc")
+        response = dialog.run()
+        file_name = dialog.get_filename()
+        dialog.destroy()
+        if response != Gtk.ResponseType.ACCEPT:
+            return
 
-        # print time
-        print("Total time: %.3f minutes" % ((time() - t) / 60))
+        [time_series, lats, longs, all_data, labels, records, coverage, series, out_rem, parameters] = self.area
+        self.pb.set_text("Saving...")
 
-        self.pb.set_text("Total processing time: %.3f minutes" % ((time() - t) / 60))
-        self.button.set_label("Process")
-        self.button.set_sensitive(True)
-        while Gtk.events_pending():
-            Gtk.main_iteration()
+        def work(cancel):
+            if file_name.lower().endswith(".nc"):
+                proc.save_netcdf(file_name, time_series, lats, longs, all_data, {}, out_rem, coverage, series,
+                                 parameters, labels, records)
+            elif file_name.lower().endswith((".tif", ".tiff")):
+                proc.save_geotiff(file_name, time_series, lats, longs, all_data, {}, out_rem, coverage, series,
+                                  parameters)
+            else:
+                proc.save_matrix(file_name, time_series, all_data, {}, labels, records)
+            return file_name
 
-        self.ts = time_series
-        self.all = all_data
-        self.i = r_i
-        self.j = r_j
+        self.run_in_background(work, self.area_saved)
 
-        self.showMapAnimation()
+    def area_saved(self, file_name):
+        self.pb.set_text("Area saved in " + file_name)
 
     #########################################################################
     # - Graphs
     #########################################################################
     # Plots the filtered time series in a new window, line graphs
-    def showGraphFiltered(self, tline, data_raw, f_pyramid, f_mean, f_gauss, f_outlier, f_SG, f_WT_E, coverage, graph_type):
-
-        # Prepares data to print in polar
-        def polar(tline,data_raw):
-            jdates = tline.copy()
-            # julian days
-            for i in range(len(jdates)):
-                jdates[i] = (datetime.datetime.combine(jdates[i], datetime.datetime.min.time())).timetuple().tm_yday
-            jdates = np.asarray(jdates).astype(np.float)
-            a = jdates.copy()
-            o = jdates.copy()
-            for i in range(len(jdates)):
-                a[i] = float(data_raw[i] * np.cos(2 * np.pi * jdates[i] / 365.0))
-                o[i] = float(data_raw[i] * np.sin(2 * np.pi * jdates[i] / 365.0))
-            return a,o
+    def showGraphFiltered(self, tline, data_raw, data_wo_outlier, filtered, f_outlier, coverage, graph_type):
 
         print(type(tline))
         print(type(tline[0]))
@@ -915,67 +824,26 @@ class Window(Gtk.ApplicationWindow):
             ax.plot(tline, data_raw, ':', color="grey", label="Raw data")
         elif graph_type=="Polar":
             fig, ax = plt.subplots(figsize=(7, 8))
-            [a,o] = polar(tline, data_raw)
+            [a, o] = proc.polar_coordinates(tline, data_raw)
             ax.plot(a, o, ':', color="grey", label="Raw data")
         fig.canvas.set_window_title('Graph')
 
-        # Size of the convlution mask
-        mask_size = 2
-
         # Plot a line with outlier removed
         if f_outlier:
-            data_filtered = self.remove_outliers(data_raw)
-            data_raw = data_filtered.copy()
             if graph_type == "Line":
-                ax.plot(tline, data_filtered, '-', linewidth="1", color="grey", label="Outliers Removed")
+                ax.plot(tline, data_wo_outlier, '-', linewidth="1", color="grey", label="Outliers Removed")
             elif graph_type=="Polar":
-                [a, o] = polar(tline, data_raw)
+                [a, o] = proc.polar_coordinates(tline, data_wo_outlier)
                 ax.plot(a, o, '-', linewidth="1", color="black", label="Outliers Removed")
 
-        # Plot if pyramid filter selected
-        if f_pyramid:
-            data_filtered = self.filter_pyramid(data_raw)
-            if graph_type=="Line":
-                ax.plot(tline, data_filtered, '-', color="red", label="Pyramid Filter")
-            elif graph_type=="Polar":
-                [a, o] = polar(tline, data_filtered)
-                ax.plot(a, o, '-', color="red", label="Pyramid Filter")
-
-        # plot if mean filter selected
-        if f_mean:
-            data_filtered = self.filter_mean(data_raw)
-            if graph_type=="Line":
-                ax.plot(tline, data_filtered, '-', color="blue", label="Mean Filter")
-            elif graph_type=="Polar":
-                [a, o] = polar(tline, data_filtered)
-                ax.plot(a, o, '-', color="blue", label="Mean Filter")
-
-        # plot if gauss filter selected
-        if f_gauss:
-            data_filtered = self.filter_gauss(data_raw)
-            if graph_type == "Line":
-                ax.plot(tline, data_filtered, '-', color="orange", label="Gauss Filter")
-            elif graph_type == "Polar":
-                [a, o] = polar(tline, data_filtered)
-                ax.plot(a, o, '-', color="orange", label="Gauss Filter")
-
-        # plot if Savitzky-Golay selected
-        if f_SG:
-            data_filtered = self.filter_savitzky_golay(data_raw)
-            if graph_type=="Line":
-                ax.plot(tline, data_filtered, '-', color="green", label="Savitzky-Golay Filter")
-            elif graph_type=="Polar":
-                [a, o] = polar(tline, data_filtered)
-                ax.plot(a, o, '-', color="green", label="Savitzky-Golay Filter")
-
-        # plot if Whittaker selected
-        if f_WT_E:
-            data_filtered = self.filter_whittaker_eilers(data_raw)
-            if graph_type == "Line":
-                ax.plot(tline, data_filtered, '-', color="purple", label="Wittaker Filter")
-            elif graph_type == "Polar":
-                [a, o] = polar(tline, data_filtered)
-                ax.plot(a, o, '-', color="purple", label="Whittaker Filter")
+        # Plot the selected filters
+        for name, label in proc.filters_list:
+            if name in filtered:
+                if graph_type == "Line":
+                    ax.plot(tline, filtered[name], '-', color=filter_colors[name], label=label)
+                elif graph_type == "Polar":
+                    [a, o] = proc.polar_coordinates(tline, filtered[name])
+                    ax.plot(a, o, '-', color=filter_colors[name], label=label)
 
         plt.title(coverage.upper() + " Time Series", fontweight='bold')
         if graph_type=="Line":
@@ -988,25 +856,31 @@ class Window(Gtk.ApplicationWindow):
 
         plt.show()
 
-    def callMapAnimation(self, x, y, t1, t2, series, cov, poly, out_rem):
+    def callMapAnimation(self, x, y, t1, t2, coverage, series, polys, records, out_rem):
 
-        self.task = self.retrieveDataMatrix(min(y), max(y), min(x), max(x), t1, t2, series, cov, poly, out_rem)
+        self.task = self.retrieveDataMatrix(min(y), max(y), min(x), max(x), t1, t2, coverage, series, polys, records,
+                                            out_rem)
         # GLib.idle_add(lambda: next(self.task, False), priority=GLib.PRIORITY_LOW)
 
     def showMapAnimation(self):
+        # frames contiguous in memory, downsampled for large areas, with the
+        # same color scale for all of them
+        frames = modis_render.prepare_frames(self.all)
+        [vmin, vmax] = modis_render.color_scale(frames)
+
         fig, ax = plt.subplots()
-        ax.set_xlim((0, self.j))
-        ax.set_ylim((0, self.i))
-        im = ax.imshow(self.all[:, :, 0], cmap="summer")
+        ax.set_xlim((0, frames.shape[2]))
+        ax.set_ylim((0, frames.shape[1]))
+        im = ax.imshow(frames[0], cmap="summer", vmin=vmin, vmax=vmax)
         title = ax.text(0.5, .95, "", bbox={'facecolor': 'w', 'alpha': 0.5, 'pad': 5},
                         transform=ax.transAxes, ha="center")
 
         def init():
-            im.set_data(self.all[:, :, 0])
+            im.set_data(frames[0])
             return (im,)
 
         def animate(i):
-            data_slice = self.all[:, :, i]
+            data_slice = frames[i]
             im.set_data(data_slice)
             title.set_text(str(self.ts[i]))
             return (im, title,)
@@ -1014,132 +888,6 @@ class Window(Gtk.ApplicationWindow):
         anim = animation.FuncAnimation(fig, animate, init_func=init, frames=self.all.shape[2], interval=int(10000/self.all.shape[2]), blit=True)
         plt.show()
 
-    #########################################################################
-    # - Filtering methods
-    #########################################################################
-    # pyramid filtering method to the time series. Filter only to the test.
-    def filter_pyramid(self, ts):
-        ts_filtered = ts.copy()
-        global window_size_pyramid
-        n_p = int((window_size_pyramid-1)/2)
-
-        for j in range(n_p, len(ts_filtered) - n_p):
-            ts_filtered[j] = 0.
-            for i in range(-1 * n_p, n_p + 1):
-                ts_filtered[j] = ts_filtered[j] + (abs(abs(i) - (n_p + 1)) * ts[j + i] / ((n_p + 1) ** 2))
-
-        return ts_filtered
-
-    # Mean filtering method
-    def filter_mean(self, ts):
-        ts_filtered = ts.copy()
-        global window_size_mean
-        n_p = int((window_size_mean-1)/2)
-
-        for j in range(n_p, len(ts_filtered) - n_p):
-            ts_filtered[j] = np.mean(ts[(j-n_p):(j+n_p+1)])
-
-        return ts_filtered
-
-    # Gauss filtering method
-    def filter_gauss(self, time_series):
-
-        ts_filtered = time_series.copy()
-        global window_size_GA
-        global sigma_GA
-        mi = 0
-
-        n_p = int((window_size_GA - 1) / 2)
-
-        # defining the mask
-        mask = np.zeros(window_size_GA)
-        for t in range(-n_p, n_p + 1):
-            mask[t + n_p] = float(
-                (1 / (sigma_GA * math.sqrt(2 * math.pi))) * math.e ** ((-1 / 2) * (((t - mi) ** 2) / sigma_GA ** 2)))
-
-        for j in range(n_p, len(time_series) - n_p):
-            a = np.asarray(time_series[j - n_p:j + n_p + 1])
-            soma = np.sum(np.asarray(mask) * a)
-            ts_filtered[j] = soma / np.sum(mask)
-        return ts_filtered
-
-    # savitzky golay filtering method.
-    # Source: https://scipy-cookbook.readthedocs.io/items/SavitzkyGolay.html
-    def filter_savitzky_golay(self, ts):
-        from math import factorial
-
-        global window_size_SG, order_SG, deriv_SG, rate_SG
-        window_size = window_size_SG
-        order = order_SG
-        deriv = deriv_SG
-        rate = rate_SG
-
-        y = np.asarray(ts)
-
-        try:
-            window_size = np.abs(np.int(window_size))
-            order = np.abs(np.int(order))
-        except ValueError:
-            print("window_size and order have to be of type int")
-        if window_size % 2 != 1 or window_size < 1:
-            raise TypeError("window_size size must be a positive odd number")
-        if window_size < order + 2:
-            raise TypeError("window_size is too small for the polynomials order")
-        order_range = range(order + 1)
-        half_window = (window_size - 1) // 2
-        # precompute coefficients
-        b = np.mat([[k ** i for i in order_range] for k in range(-half_window, half_window + 1)])
-        m = np.linalg.pinv(b).A[deriv] * rate ** deriv * factorial(deriv)
-        # pad the signal at the extremes with
-        # values taken from the signal itself
-        firstvals = y[0] - np.abs(y[1:half_window + 1][::-1] - y[0])
-        lastvals = y[-1] + np.abs(y[-half_window - 1:-1][::-1] - y[-1])
-        y = np.concatenate((firstvals, y, lastvals))
-        return np.convolve(m[::-1], y, mode='valid')
-
-    # Whittaker filtering method.
-    # Source: https://github.com/mhvwerts/whittaker-eilers-smoother/blob/master/whittaker_smooth.py
-    def filter_whittaker_eilers(self, y):
-        global window_size_WT_E
-        global lmbd_WT_E
-
-        d = window_size_WT_E//2 + 1
-        lmbd = lmbd_WT_E
-
-        def speyediff(N, d, format='csc'):
-            assert not (d < 0), "d must be non negative"
-            shape = (N - d, N)
-            diagonals = np.zeros(2 * d + 1)
-            diagonals[d] = 1.
-            for i in range(d):
-                diff = diagonals[:-1] - diagonals[1:]
-                diagonals = diff
-            offsets = np.arange(d + 1)
-            spmat = sparse.diags(diagonals, offsets, shape, format=format)
-            return spmat
-
-        m = len(y)
-        E = sparse.eye(m, format='csc')
-        D = speyediff(m, d, format='csc')
-        coefmat = E + lmbd * D.conj().T.dot(D)
-        z = splu(coefmat).solve(np.asarray(y))
-
-        return z
-
-    # Removing outliers
-    # Paper: https://www.mdpi.com/2072-4292/5/12/6159
-    def remove_outliers(self, ts):
-        ts_corrected = ts.copy()
-        global percent_outliers_removal
-        per = percent_outliers_removal/100
-
-        for j in range(1, len(ts_corrected) - 1):
-            if (ts[j]-ts[j-1]<-per*ts[j-1]) and (ts[j]-ts[j+1]<-per*ts[j+1]):
-                ts_corrected[j] = (ts[j-1]+ts[j+1])/2
-
-        return ts_corrected
-
-
     #########################################################################
     # - Settings
     #########################################################################